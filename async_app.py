@@ -0,0 +1,504 @@
+"""
+非同步 (aiohttp) 版本的 LINE webhook，跟 main:app 並存，對話流程跟 main.py 共用 conversation 模組
+等待 LINE API、後端和資料庫時不佔用執行緒，一個行程可以同時處理幾百個事件
+
+    LINE API: AsyncApiClient / AsyncMessagingApi
+    後端 API: async_backend_client.AsyncBackendClient (aiohttp)
+    資料庫:   async_persistence (阻塞的呼叫放到執行緒池)
+
+webhook 收到事件後驗證簽章、去重，建立背景 task 處理後馬上回 200
+同一個使用者的事件依收到的順序一個一個處理，不同使用者同時處理
+push (reply token 過期或超過 5 則) 一樣交給 push_queue 做速率限制
+
+啟動:
+    python async_app.py
+    gunicorn async_app:app --worker-class aiohttp.GunicornWebWorker
+
+環境變數 (其他同 main.py):
+    ASYNC_MAX_IN_FLIGHT 同時處理中的事件上限，預設 500，超過時回 503 讓 LINE 之後重送
+    EVENT_DRAIN_TIMEOUT 結束時等待處理中事件的秒數，預設 10
+
+"""
+
+import asyncio
+import json
+import logging
+import os
+
+import aiohttp
+from aiohttp import web
+from dotenv import load_dotenv
+from linebot.v3 import WebhookParser
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.messaging import (
+    ApiException,
+    AsyncApiClient,
+    AsyncMessagingApi,
+    Configuration,
+    TextMessage,
+)
+from linebot.v3.webhooks import (
+    FollowEvent,
+    MessageEvent,
+    PostbackEvent,
+    TextMessageContent,
+    UnfollowEvent,
+)
+
+import async_persistence as adb
+import conversation
+import event_dedup
+import line_client
+import persistence as db
+import push_queue
+import reminders
+import stamp_counters
+import stamp_journal
+import templates
+from async_backend_client import AsyncBackendClient, CircuitOpenError, not_sent
+from backend_client import BackendClient
+from message_composer import MessageComposer
+from message_composer import stats as message_stats
+
+logger = logging.getLogger(__name__)
+
+load_dotenv(".env")
+
+webhook = os.getenv("WEBHOOK", "/")
+
+access_token = os.getenv("ACCESS_TOKEN")
+secret = os.getenv("SECRET")
+
+configuration = Configuration(access_token=access_token)
+parser = WebhookParser(secret)
+# push_queue 使用同步的 MessagingApi
+line_client.init(configuration)
+
+BASE_URL = "https://test-1-pwmo.onrender.com"
+
+# 離線佇列的補送和點數查詢在背景執行緒內，使用同步的 BackendClient
+# 兩個 client 共用斷路器，後端掛掉時補送不會繼續打，恢復時也一起恢復
+_breakers = {}
+backend = AsyncBackendClient(BASE_URL, _breakers)
+replay_backend = BackendClient(BASE_URL, _breakers)
+
+# 使用者資料更新衝突時最多重新處理幾次
+conflict_retries = int(os.getenv("CONFLICT_RETRIES", "3"))
+max_in_flight = int(os.getenv("ASYNC_MAX_IN_FLIGHT", "500"))
+
+health_info = None
+
+# 定義全域變數
+_line_bot_api = None
+_api_client = None
+# 處理中的 task
+_tasks = set()
+# user_id -> 這個使用者最後一個 task，新的事件要等它處理完
+_tails = {}
+_stats = {"events": 0, "conflicts": 0, "rejected": 0, "errors": 0}
+
+
+# 呼叫不能重複的後端 API (集點、註冊、連結帳號)，呼叫之後這個事件不再因為資料衝突重新處理
+# 呼叫前要先在 try 外面呼叫 session.ensure_current()，ConflictError 才不會被當成一般錯誤吃掉
+async def call_once(session: adb.Session, call):
+    try:
+        return await call
+    finally:
+        session.mark_irreversible()
+
+
+# 集點並回傳 (目前的點數, 是否只先記在離線佇列)，後端拒絕時回傳 (None, False)
+# 記在離線佇列但不知道目前點數時回傳 (None, True)，呼叫端只回覆已記下、不顯示進度卡片
+# 要不要記到離線佇列見 conversation.should_journal
+async def add_stamp(
+    kind: str, user_info: dict, session: adb.Session, event_id: str = None
+):
+    key = stamp_journal.idempotency_key(event_id, kind)
+    await session.ensure_current()
+    try:
+        response = await call_once(
+            session,
+            backend.add_stamp(kind, user_info["user_id"], idempotency_key=key),
+        )
+        if response.status_code == 200:
+            count = conversation.stamped(user_info, kind, response.json().get(kind))
+            session.update(user_info)
+            return count, False
+        print(f"Stamp {kind} failed: {response.status_code}")
+        journal = conversation.should_journal(response.status_code)
+    except CircuitOpenError:
+        print(f"Stamp {kind} skipped: backend circuit is open")
+        journal = True
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Error during request: {e}")
+        journal = conversation.should_journal(not_sent=not_sent(e))
+    except Exception as e:
+        print(f"Error during request: {e}")
+        journal = False
+
+    # 後端暫時無法服務，集點先記到離線佇列
+    if not journal or not stamp_journal.enabled():
+        return None, False
+    try:
+        await adb.run(stamp_journal.record, kind, user_info["user_id"], key)
+    except Exception as e:
+        print(f"Error while journaling stamp: {e}")
+        return None, False
+    count = conversation.journaled(user_info, kind)
+    session.update(user_info)
+    return count, True
+
+
+# 不集點，只顯示知道的集點項目的進度卡片，一項都不知道時才等後端查詢
+# 要有後端的查詢 API (stamp_counters.enabled()) 才會呼叫
+# 背景查詢用同步的 replay_backend (在 stamp_counters 的執行緒內執行)
+async def show_progress(user_info: dict) -> list:
+    counts, stale = stamp_counters.lookup(
+        replay_backend, user_info["user_id"], user_info
+    )
+    if not counts:
+        counts = await asyncio.to_thread(
+            stamp_counters.load, replay_backend, user_info["user_id"]
+        )
+    return conversation.progress_messages(counts, stale)
+
+
+async def handle_message(event, session: adb.Session, composer: MessageComposer):
+    user_id = event.source.user_id
+
+    # 查詢使用者資料，取回前一次登入操作的資料，沒有就建一個新的使用者資料
+    user_info = await session.get_or_create(conversation.createUserInfo(user_id))
+
+    msg_list = await dispatch_type(
+        user_id, event.message.text, user_info, session, event.webhook_event_id
+    )
+
+    if len(msg_list) <= 0:
+        if user_info["register"] == False:
+            return
+        else:
+            # 處理其他不明訊息
+            msg_list = process_message(event.source.user_id, event.message.text)
+
+    composer.add(*msg_list)
+
+
+# 根據前一次的操作，分派訊息到對應的處理流程 (見 conversation.next_step)，這裡只負責呼叫後端
+async def dispatch_type(
+    user_id: str, message: str, user_info, session: adb.Session, event_id: str = None
+) -> list:
+    before = dict(user_info)
+    msg_list, action = conversation.next_step(message, user_info)
+    if user_info != before:
+        session.update(user_info)
+
+    if action == "stamp":
+        count, queued = await add_stamp(
+            "healthMeasurement", user_info, session, event_id
+        )
+        msg_list.extend(conversation.text_stamp_messages(count, queued))
+    elif action == "progress":
+        msg_list.extend(await show_progress(user_info))
+    elif action == "link":
+        await session.ensure_current()
+        try:
+            response = await call_once(session, backend.link_line_id(message, user_id))
+            data = response.json()
+            reply_text = conversation.link_reply(
+                user_info, response.status_code, data.get("detail")
+            )
+        except Exception as e:
+            print(f"Error during request: {e}")
+            reply_text = conversation.link_reply(user_info, None)
+        msg_list.append(TextMessage(text=reply_text))
+        conversation.reset_steps(user_info)
+        session.update(user_info)
+    elif action == "login":
+        try:
+            response = await backend.search(user_info["idNumber"])
+            if response.status_code == 200:
+                # 成功後，清掉步驟並發送操作選項
+                conversation.reset_steps(user_info)
+                session.update(user_info)
+
+                await session.ensure_current()
+                try:
+                    response = await call_once(
+                        session,
+                        backend.link_line_id(user_info["idNumber"], user_id),
+                    )
+                    conversation.link_reply(user_info, response.status_code)
+                    session.update(user_info)
+                except Exception as e:
+                    print(f"Error during request: {e}")
+
+                msg_list.append(templates.get("operation_options"))
+            else:
+                msg_list.append(TextMessage(text="請註冊!!"))
+        except db.ConflictError:
+            # 交給 dispatch_event 重新處理
+            raise
+        except Exception:
+            msg_list.append(TextMessage(text=conversation.CONTACT_ADMIN_TEXT))
+
+    return msg_list
+
+
+async def handle_postback(event, session: adb.Session, composer: MessageComposer):
+    user_info = await session.get_or_create(
+        conversation.createUserInfo(event.source.user_id)
+    )
+
+    data = event.postback.data
+
+    if data == "correct":
+        await session.ensure_current()
+        try:
+            response = await call_once(
+                session,
+                backend.add_user(
+                    user_info["name"], user_info["idNumber"], user_info["tel"]
+                ),
+            )
+            if response.status_code == 200:
+                user_info["register"] = True
+                session.update(user_info)
+                reply_text = "註冊完成！請輸入身分證字號登入"
+            else:
+                reply_text = "註冊失敗！請稍後嘗試!"
+        except Exception:
+            reply_text = conversation.CONTACT_ADMIN_TEXT
+        composer.add(TextMessage(text=reply_text))
+    elif data == "incorrect":
+        user_info = conversation.restart_registration(event.source.user_id)
+        session.update(user_info)
+
+        reply_text = "請重新輸入姓名"
+        composer.add(TextMessage(text=reply_text))
+    elif data == "start":
+        composer.add(templates.get("start_menu"))
+    elif data == "logout":
+        conversation.logged_out(user_info)
+        session.update(user_info)
+
+        try:
+            response = await backend.logout(user_info["user_id"])
+            if response.status_code == 200:
+                reply_text = "登出成功"
+            else:
+                reply_text = "請重試"
+        except Exception as e:
+            print(f"Error during request: {e}")
+            reply_text = conversation.CONTACT_ADMIN_TEXT
+        composer.add(TextMessage(text=reply_text))
+    elif data == "progress" and stamp_counters.enabled():
+        composer.add(*await show_progress(user_info))
+        composer.add(templates.get("other_operation_options"))
+    elif data in conversation.POSTBACK_KINDS:
+        kind = conversation.POSTBACK_KINDS[data]
+        count, queued = await add_stamp(
+            kind, user_info, session, event.webhook_event_id
+        )
+        composer.add(*conversation.postback_stamp_messages(kind, count, queued))
+
+
+# 加入好友
+async def handle_follow(event, session: adb.Session, composer: MessageComposer):
+    logger.info("Got Follow event:" + event.source.user_id)
+
+    try:
+        profile = await _line_bot_api.get_profile(event.source.user_id)
+        welcometitle = "您好！歡迎使用健康小幫手，您看起來還不是我們會員，請選擇新會員或其他以獲得服務。"
+        if profile.display_name:
+            welcometitle = profile.display_name + welcometitle
+
+        composer.add(TextMessage(text=welcometitle), templates.get("service_menu"))
+    except ApiException as e:
+        print(e.status)
+
+
+# 取消好友
+async def handle_unfollow(event, session: adb.Session, composer: MessageComposer):
+    logger.info("Got Unfollow event:" + event.source.user_id)
+    stamp_counters.invalidate(event.source.user_id)
+
+
+# 其他訊息的回應
+def process_message(userid: str, msg: str) -> list:
+    msg_list = []
+    if msg != None and msg != "":
+        if msg in health_info:
+            msg_list.append(TextMessage(text=health_info[msg]))
+    return msg_list
+
+
+# 讀取健康資訊
+def load_health_info(config_name: str):
+    global health_info
+    with open(config_name, "rt", encoding="utf-8") as fh:
+        health_info = json.load(fh)
+
+
+def _find_handler(event):
+    if isinstance(event, MessageEvent):
+        if isinstance(event.message, TextMessageContent):
+            return handle_message
+        return None
+    if isinstance(event, PostbackEvent):
+        return handle_postback
+    if isinstance(event, FollowEvent):
+        return handle_follow
+    if isinstance(event, UnfollowEvent):
+        return handle_unfollow
+    return None
+
+
+# 處理一個事件，資料衝突時重新讀取再處理一次
+# 已經呼叫過不能重複的後端 API (call_once) 的事件不會重新處理，寫入時改成合併最新的資料
+async def dispatch_event(event):
+    if not await adb.run(event_dedup.add_persistent, event.webhook_event_id):
+        logger.info(f"Drop duplicated event {event.webhook_event_id}")
+        return
+    func = _find_handler(event)
+    if func is None:
+        logger.info(f"No handler of {event.__class__.__name__}")
+        return
+    user_id = getattr(event.source, "user_id", None)
+    for attempt in range(conflict_retries + 1):
+        session = adb.Session(user_id)
+        composer = MessageComposer(
+            getattr(event, "reply_token", None), user_id, event.timestamp
+        )
+        try:
+            await func(event, session, composer)
+            # 先寫入使用者資料，有衝突的話重新處理時才不會重複回覆
+            await session.commit()
+            await composer.send_async(_line_bot_api)
+            return
+        except db.ConflictError as e:
+            _stats["conflicts"] += 1
+            logger.warning(f"Retry event after conflict: {e}")
+    logger.error(f"Give up event {event.webhook_event_id} after conflicts")
+
+
+# 等同一個使用者前一個事件處理完才開始
+async def _run_after(previous, event):
+    if previous is not None:
+        await asyncio.wait([previous])
+    try:
+        await dispatch_event(event)
+    except Exception as e:
+        _stats["errors"] += 1
+        logger.exception(f"Error while handling event: {e}")
+
+
+def _submit(event) -> bool:
+    if len(_tasks) >= max_in_flight:
+        return False
+    key = getattr(event.source, "user_id", None)
+    previous = _tails.get(key) if key is not None else None
+    task = asyncio.create_task(_run_after(previous, event))
+    _tasks.add(task)
+    if key is not None:
+        _tails[key] = task
+
+    def done(t):
+        _tasks.discard(t)
+        if key is not None and _tails.get(key) is t:
+            del _tails[key]
+
+    task.add_done_callback(done)
+    _stats["events"] += 1
+    return True
+
+
+async def linebot(request: web.Request) -> web.Response:
+    signature = request.headers.get("X-Line-Signature", "")
+    body = await request.text()
+
+    # 只驗證簽章並解析事件，處理交給背景 task，先回 200 給 LINE
+    try:
+        events = parser.parse(body, signature)
+    except InvalidSignatureError:
+        raise web.HTTPBadRequest()
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        return web.Response(text="OK")
+
+    for event in events:
+        # LINE 重送的事件 id 不變，已經收過就直接丟掉
+        if not event_dedup.add(event.webhook_event_id):
+            logger.info(f"Drop duplicated event {event.webhook_event_id}")
+            continue
+        if not _submit(event):
+            # 處理中的事件太多，回 503 讓 LINE 之後重送
+            event_dedup.discard(event.webhook_event_id)
+            _stats["rejected"] += 1
+            raise web.HTTPServiceUnavailable()
+
+    return web.Response(text="OK")
+
+
+async def status(request: web.Request) -> web.Response:
+    return web.json_response(
+        {
+            "events": dict(_stats, in_flight=len(_tasks), users=len(_tails)),
+            "backend": backend.stats(),
+            "dedup": event_dedup.stats(),
+            "messages": message_stats(),
+            "push": push_queue.stats(),
+            "reminders": reminders.stats(),
+            "stamp_journal": stamp_journal.stats(),
+            "stamp_counters": stamp_counters.stats(),
+            "cache": db.cache_stats(),
+            "memory_store": db.store_stats(),
+        }
+    )
+
+
+async def on_startup(app: web.Application):
+    global _api_client, _line_bot_api
+    _api_client = AsyncApiClient(configuration)
+    _line_bot_api = AsyncMessagingApi(_api_client)
+    # 提醒用 line_client (同步的 MessagingApi) 送出，在自己的執行緒內執行
+    reminders.start()
+    stamp_journal.start(replay_backend)
+
+
+# 等處理中的事件結束再關閉連線
+async def on_cleanup(app: web.Application):
+    if _tasks:
+        timeout = float(os.getenv("EVENT_DRAIN_TIMEOUT", "10"))
+        done, pending = await asyncio.wait(list(_tasks), timeout=timeout)
+        if pending:
+            logger.warning(f"{len(pending)} events not finished at shutdown")
+    await backend.close()
+    await _api_client.close()
+    adb.shutdown()
+
+
+def create_app() -> web.Application:
+    app = web.Application()
+    app.router.add_post(webhook, linebot)
+    app.router.add_get("/status", status)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+db.init_db()
+load_health_info("bot_health_info.json")
+templates.warm_up()
+
+app = create_app()
+
+
+def main():
+    host_ip = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", 5000))
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(app, host=host_ip, port=port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+後端 API 的非同步連線模組，給 async_app 使用
+跟 backend_client.BackendClient 的設定、重試和斷路器規則相同，只是改用 aiohttp
+等待後端回應時不佔用執行緒，一個行程可以同時等很多個請求
+
+環境變數同 backend_client (BACKEND_POOL_SIZE、BACKEND_CONNECT_TIMEOUT、BACKEND_READ_TIMEOUT、
+BACKEND_RETRIES、BACKEND_BACKOFF、BACKEND_BACKOFF_MAX、BACKEND_BREAKER_FAILURES、BACKEND_BREAKER_RESET)
+
+"""
+
+import asyncio
+import json
+import os
+import random
+
+import aiohttp
+
+from backend_client import RETRY_STATUS, CircuitBreaker, CircuitOpenError
+
+
+# 請求確定沒有送到後端: 斷路器打開、連線逾時或連線建立失敗 (跟 backend_client.not_sent 相同)
+def not_sent(e: Exception) -> bool:
+    return isinstance(
+        e,
+        (CircuitOpenError, aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError),
+    )
+
+
+# 已經讀完內容的回應，用法跟 requests.Response 一樣 (status_code / json())
+class BackendResponse:
+    def __init__(self, status_code: int, content: bytes):
+        self.status_code = status_code
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+    def __repr__(self):
+        return f"<BackendResponse [{self.status_code}]>"
+
+
+class AsyncBackendClient:
+    # breakers 可以跟 BackendClient 共用 (CircuitBreaker 有自己的鎖，執行緒間共用沒有問題)
+    def __init__(self, base_url: str, breakers: dict = None):
+        self.base_url = base_url.rstrip("/")
+        self.pool_size = int(os.getenv("BACKEND_POOL_SIZE", "10"))
+        self.timeout = aiohttp.ClientTimeout(
+            sock_connect=float(os.getenv("BACKEND_CONNECT_TIMEOUT", "3.05")),
+            sock_read=float(os.getenv("BACKEND_READ_TIMEOUT", "10")),
+        )
+        self.retries = int(os.getenv("BACKEND_RETRIES", "2"))
+        self.backoff = float(os.getenv("BACKEND_BACKOFF", "0.2"))
+        self.backoff_max = float(os.getenv("BACKEND_BACKOFF_MAX", "2"))
+        self.breaker_failures = int(os.getenv("BACKEND_BREAKER_FAILURES", "5"))
+        self.breaker_reset = float(os.getenv("BACKEND_BREAKER_RESET", "30"))
+        self._breakers = breakers if breakers is not None else {}
+        self._session = None
+
+    def build_url(self, path: str) -> str:
+        return f"{self.base_url}{path}"
+
+    # ClientSession 要在 event loop 內建立，第一次呼叫時才建立
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=self.timeout,
+            )
+        return self._session
+
+    def breaker(self, path: str) -> CircuitBreaker:
+        breaker = self._breakers.get(path)
+        if breaker is None:
+            breaker = self._breakers.setdefault(
+                path, CircuitBreaker(self.breaker_failures, self.breaker_reset)
+            )
+        return breaker
+
+    # 送出請求，idempotent 表示重送也不會有副作用，可以在讀取逾時或 5xx 時重試
+    async def request(
+        self, method: str, path: str, idempotent: bool = False, **kwargs
+    ) -> BackendResponse:
+        breaker = self.breaker(path)
+        attempt = 0
+        while True:
+            breaker.before_call()
+            try:
+                async with self.session().request(
+                    method, self.build_url(path), **kwargs
+                ) as response:
+                    content = await response.read()
+                    result = BackendResponse(response.status, content)
+            except (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError):
+                # 連線都還沒建立，請求一定沒送出去，不冪等的呼叫也可以重試
+                breaker.record_failure()
+                if attempt >= self.retries:
+                    raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                breaker.record_failure()
+                if not idempotent or attempt >= self.retries:
+                    raise
+            except Exception:
+                breaker.record_failure()
+                raise
+            else:
+                if result.status_code < 500:
+                    breaker.record_success()
+                    return result
+                breaker.record_failure()
+                if (
+                    not idempotent
+                    or result.status_code not in RETRY_STATUS
+                    or attempt >= self.retries
+                ):
+                    return result
+            # full jitter: 在 0 到目前上限之間隨機等待
+            delay = min(self.backoff_max, self.backoff * 2**attempt)
+            await asyncio.sleep(random.uniform(0, delay))
+            attempt += 1
+
+    def stats(self) -> dict:
+        return {path: breaker.stats() for path, breaker in self._breakers.items()}
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+        self._session = None
+
+    # 集點，idempotency_key 相同的請求後端只會處理一次 (離線佇列補送時使用)
+    async def add_stamp(
+        self, kind: str, line_id: str, idempotency_key: str = None
+    ) -> BackendResponse:
+        headers = {"Idempotency-Key": idempotency_key} if idempotency_key else None
+        return await self.request(
+            "PUT", f"/add/{kind}", json={"lineId": line_id}, headers=headers
+        )
+
+    # 會員
+    async def link_line_id(self, id_number: str, line_id: str) -> BackendResponse:
+        return await self.request(
+            "POST", "/linkLineID/", json={"idNumber": id_number, "lineId": line_id}
+        )
+
+    async def search(self, id_number: str) -> BackendResponse:
+        return await self.request(
+            "GET", "/search/", idempotent=True, json={"idNumber": id_number}
+        )
+
+    async def search_line_id(self, line_id: str) -> BackendResponse:
+        return await self.request(
+            "POST", "/searchLineID/", idempotent=True, json={"lineId": line_id}
+        )
+
+    async def add_user(self, name: str, id_number: str, tel: str) -> BackendResponse:
+        return await self.request(
+            "POST",
+            "/add_user/",
+            json={"name": name, "idNumber": id_number, "tel": tel},
+        )
+
+    async def logout(self, line_id: str) -> BackendResponse:
+        return await self.request(
+            "DELETE", "/logout/", idempotent=True, json={"lineId": line_id}
+        )
@@ -0,0 +1,124 @@
+"""
+persistence 的非同步介面，給 async_app 使用
+MongoDB / SQLite 的呼叫會阻塞，放到執行緒池內執行，不會卡住 event loop
+記憶體模式只是加鎖存取 dict，直接在 event loop 內呼叫，省掉切換執行緒的成本
+
+persistence 的 unit_of_work 是以執行緒區分的，在 async 裡面改用 Session:
+事件處理中的更新只記在 Session 內，處理完呼叫 commit() 一次寫入有變動的欄位
+version 對不上時一樣丟出 persistence.ConflictError，呼叫端重新處理
+呼叫不能重複的後端 API 前後用 Session.ensure_current() / mark_irreversible()，規則跟 persistence 相同
+
+環境變數:
+    ASYNC_DB_THREADS 執行資料庫呼叫的執行緒數量，預設 16
+
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import persistence as db
+
+# 定義全域變數
+_executor = None
+
+
+def _blocking() -> bool:
+    return db.collection is not None or not isinstance(db.user_map, db.MemoryStore)
+
+
+async def _call(func, *args):
+    global _executor
+    if not _blocking():
+        return func(*args)
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("ASYNC_DB_THREADS", "16")),
+            thread_name_prefix="async-db",
+        )
+    return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+
+
+async def get_or_create(userID: str, defaults: dict, fields=db.SESSION_FIELDS):
+    return await _call(db.get_or_create, userID, defaults, fields)
+
+
+async def query_data(userID: str, fields=db.SESSION_FIELDS):
+    return await _call(db.query_data, userID, fields)
+
+
+async def insert_data(userID: str, data: dict):
+    return await _call(db.insert_data, userID, data)
+
+
+async def update_data(userID: str, data: dict):
+    return await _call(db.update_data, userID, data)
+
+
+async def delete_data(userID: str):
+    return await _call(db.delete_data, userID)
+
+
+async def mark_event(eventID: str, window: float) -> bool:
+    return await _call(db.mark_event, eventID, window)
+
+
+# 執行在 event loop 內的函式也可能碰到資料庫 (例如 event_dedup.add_persistent)
+async def run(func, *args):
+    return await _call(func, *args)
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+# 一個事件對一位使用者資料的讀取和更新
+class Session:
+    def __init__(self, userID: str):
+        self.user_id = userID
+        self.snapshot = None
+        self.pending = None
+        self.irreversible = False
+        # 讀到的資料來自這個 worker 的快取，還沒經過 version 檢查
+        self.cached = False
+
+    async def get_or_create(self, defaults: dict) -> dict:
+        if self.pending is not None:
+            return dict(self.pending)
+        result, cached = await _call(db.get_or_create_cached, self.user_id, defaults)
+        if self.snapshot is None:
+            self.snapshot = dict(result)
+            self.cached = cached
+        return result
+
+    # 記下這個時間點的內容，commit() 時才寫入
+    def update(self, data: dict):
+        self.pending = dict(data)
+
+    # 寫入有變動的欄位，沒有寫入而讀到的是快取的資料時，確認還是最新的 (跟 unit_of_work 相同)
+    async def commit(self):
+        if self.pending is None:
+            if self.cached and not self.irreversible and self.snapshot is not None:
+                self.cached = False
+                await _call(db.revalidate, self.user_id, self.snapshot.get("version"))
+            return
+        pending, self.pending = self.pending, None
+        version = await _call(
+            db.save_changes, self.user_id, self.snapshot, pending, self.irreversible
+        )
+        self.snapshot = dict(pending, version=version)
+        self.cached = False
+
+    # 先寫入暫存的更新，再確認讀到的資料還是最新的，被別人改過就丟出 ConflictError
+    async def ensure_current(self):
+        checked = self.pending is None and self.cached
+        await self.commit()
+        if checked or self.snapshot is None or self.irreversible:
+            return
+        await _call(db.revalidate, self.user_id, self.snapshot.get("version"))
+
+    def mark_irreversible(self):
+        self.irreversible = True
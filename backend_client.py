@@ -0,0 +1,259 @@
+"""
+後端 API 的連線模組
+每個 worker 行程共用一個有連線池的 requests.Session，連到後端時可以重複使用 keep-alive 連線
+不用每次集點都重新做 TCP + TLS 交握
+
+環境變數:
+    BACKEND_POOL_SIZE       連線池大小，預設 10
+    BACKEND_CONNECT_TIMEOUT 連線逾時秒數，預設 3.05
+    BACKEND_READ_TIMEOUT    讀取逾時秒數，預設 10
+    BACKEND_STAMPS_PATH     查詢點數 (不集點) 的路徑，後端提供之後再設定，預設不使用
+
+後端冷啟動或故障時的處理:
+    冪等的呼叫 (查詢、登出) 在連線失敗、逾時或 502/503/504 時，以加上隨機抖動的指數退避重試
+    集點這類不冪等的呼叫只在確定沒送出去 (連線逾時) 時才重試，避免重複集點
+    每個 endpoint 有自己的斷路器，連續失敗太多次就暫停呼叫，直接丟出 CircuitOpenError
+
+    BACKEND_RETRIES         最多重試次數，預設 2
+    BACKEND_BACKOFF         第一次重試前最多等待的秒數，之後每次加倍，預設 0.2
+    BACKEND_BACKOFF_MAX     重試等待秒數上限，預設 2
+    BACKEND_BREAKER_FAILURES 連續失敗幾次打開斷路器，預設 5
+    BACKEND_BREAKER_RESET   斷路器打開幾秒後放一個請求試試看，預設 30
+    BACKEND_IDEMPOTENCY_KEYS 後端確定會依 Idempotency-Key 去除重複的集點時設成 true，預設 false
+                            沒有設定時，集點只有在確定沒送出去時才會記到離線佇列補送
+
+"""
+
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+# 這些狀態碼代表後端暫時無法服務，可以重試
+RETRY_STATUS = (502, 503, 504)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def idempotency_supported() -> bool:
+    return os.getenv("BACKEND_IDEMPOTENCY_KEYS", "false").lower() == "true"
+
+
+# 請求確定沒有送到後端: 斷路器打開、連線逾時或連線建立失敗 (例如 DNS、連線被拒)
+# 讀取逾時或連線中途斷掉時，後端可能已經處理過了
+def not_sent(e: Exception) -> bool:
+    if isinstance(e, (CircuitOpenError, requests.ConnectTimeout)):
+        return True
+    if isinstance(e, requests.ConnectionError):
+        reason = getattr(e.args[0], "reason", None) if e.args else None
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+# 斷路器: closed 正常呼叫，open 直接拒絕，half-open 放一個請求試試看
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_call(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return
+            if state == "half-open" and not self.trial:
+                self.trial = True
+                return
+            self.rejected += 1
+            raise CircuitOpenError("backend circuit is open")
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "rejected": self.rejected,
+        }
+
+
+class BackendClient:
+    # breakers 可以跟其他 client (例如 AsyncBackendClient) 共用，看到同一個後端狀態
+    def __init__(self, base_url: str, breakers: dict = None):
+        self.base_url = base_url.rstrip("/")
+        self.pool_size = int(os.getenv("BACKEND_POOL_SIZE", "10"))
+        self.timeout = (
+            float(os.getenv("BACKEND_CONNECT_TIMEOUT", "3.05")),
+            float(os.getenv("BACKEND_READ_TIMEOUT", "10")),
+        )
+        self.retries = int(os.getenv("BACKEND_RETRIES", "2"))
+        self.backoff = float(os.getenv("BACKEND_BACKOFF", "0.2"))
+        self.backoff_max = float(os.getenv("BACKEND_BACKOFF_MAX", "2"))
+        self.breaker_failures = int(os.getenv("BACKEND_BREAKER_FAILURES", "5"))
+        self.breaker_reset = float(os.getenv("BACKEND_BREAKER_RESET", "30"))
+        self.stamps_path = os.getenv("BACKEND_STAMPS_PATH")
+        self._breakers = breakers if breakers is not None else {}
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def build_url(self, path: str) -> str:
+        return f"{self.base_url}{path}"
+
+    # 取得這個行程的 Session，gunicorn fork 之後會在子行程重新建立
+    def session(self) -> requests.Session:
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = HTTPAdapter(
+                        pool_connections=1, pool_maxsize=self.pool_size
+                    )
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+                    self._pid = os.getpid()
+        return self._session
+
+    def breaker(self, path: str) -> CircuitBreaker:
+        breaker = self._breakers.get(path)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(
+                    path, CircuitBreaker(self.breaker_failures, self.breaker_reset)
+                )
+        return breaker
+
+    # 送出請求，idempotent 表示重送也不會有副作用，可以在讀取逾時或 5xx 時重試
+    def request(
+        self, method: str, path: str, idempotent: bool = False, **kwargs
+    ) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        breaker = self.breaker(path)
+        attempt = 0
+        while True:
+            breaker.before_call()
+            try:
+                response = self.session().request(
+                    method, self.build_url(path), **kwargs
+                )
+            except requests.ConnectTimeout:
+                # 連線都還沒建立，請求一定沒送出去，不冪等的呼叫也可以重試
+                breaker.record_failure()
+                if attempt >= self.retries:
+                    raise
+            except (requests.ConnectionError, requests.Timeout):
+                breaker.record_failure()
+                if not idempotent or attempt >= self.retries:
+                    raise
+            except Exception:
+                breaker.record_failure()
+                raise
+            else:
+                if response.status_code < 500:
+                    breaker.record_success()
+                    return response
+                breaker.record_failure()
+                if (
+                    not idempotent
+                    or response.status_code not in RETRY_STATUS
+                    or attempt >= self.retries
+                ):
+                    return response
+            # full jitter: 在 0 到目前上限之間隨機等待
+            delay = min(self.backoff_max, self.backoff * 2**attempt)
+            time.sleep(random.uniform(0, delay))
+            attempt += 1
+
+    def stats(self) -> dict:
+        return {path: breaker.stats() for path, breaker in self._breakers.items()}
+
+    def close(self):
+        if self._session is not None and self._pid == os.getpid():
+            self._session.close()
+        self._session = None
+        self._pid = None
+
+    # 集點，idempotency_key 相同的請求後端只會處理一次 (離線佇列補送時使用)
+    def add_stamp(
+        self, kind: str, line_id: str, idempotency_key: str = None
+    ) -> requests.Response:
+        headers = {"Idempotency-Key": idempotency_key} if idempotency_key else None
+        return self.request(
+            "PUT", f"/add/{kind}", json={"lineId": line_id}, headers=headers
+        )
+
+    def add_health_measurement(self, line_id: str) -> requests.Response:
+        return self.add_stamp("healthMeasurement", line_id)
+
+    def add_health_education(self, line_id: str) -> requests.Response:
+        return self.add_stamp("healthEducation", line_id)
+
+    def add_exercise(self, line_id: str) -> requests.Response:
+        return self.add_stamp("exercise", line_id)
+
+    # 查詢目前的點數，不會集點，回應的格式跟集點相同 ({"healthMeasurement": 3, ...})
+    def get_stamps(self, line_id: str) -> requests.Response:
+        if not self.stamps_path:
+            raise RuntimeError("BACKEND_STAMPS_PATH is not set")
+        return self.request(
+            "POST", self.stamps_path, idempotent=True, json={"lineId": line_id}
+        )
+
+    # 會員
+    def link_line_id(self, id_number: str, line_id: str) -> requests.Response:
+        return self.request(
+            "POST", "/linkLineID/", json={"idNumber": id_number, "lineId": line_id}
+        )
+
+    def search(self, id_number: str) -> requests.Response:
+        return self.request(
+            "GET", "/search/", idempotent=True, json={"idNumber": id_number}
+        )
+
+    def search_line_id(self, line_id: str) -> requests.Response:
+        return self.request(
+            "POST", "/searchLineID/", idempotent=True, json={"lineId": line_id}
+        )
+
+    def add_user(self, name: str, id_number: str, tel: str) -> requests.Response:
+        return self.request(
+            "POST",
+            "/add_user/",
+            json={"name": name, "idNumber": id_number, "tel": tel},
+        )
+
+    def logout(self, line_id: str) -> requests.Response:
+        return self.request(
+            "DELETE", "/logout/", idempotent=True, json={"lineId": line_id}
+        )
@@ -0,0 +1,50 @@
+"""
+進度條卡片的效能比較
+    原本的作法: progress_bar() 產生 dict，再用 FlexContainer.from_dict 建立訊息
+    快取: progress_card.render()，相同點數直接回傳做好的訊息
+
+執行: python bench_progress_card.py
+
+"""
+
+import itertools
+import timeit
+
+from linebot.v3.messaging import FlexContainer, FlexMessage
+
+import progress_card
+from progress_card import CARDS, progress_bar
+
+# 實際會出現的組合: 三種集點項目，各自的點數範圍
+CASES = [
+    (title, "目前集點進度", current, max)
+    for title, max in CARDS.values()
+    for current in range(max + 3)
+]
+
+
+def original(args):
+    return FlexMessage(
+        alt_text="hello", contents=FlexContainer.from_dict(progress_bar(*args))
+    )
+
+
+def cached(args):
+    return progress_card.render(*args)
+
+
+def main():
+    number = 2000
+    funcs = [("original", original), ("cached", cached)]
+    for name, func in funcs:
+        # 先每種組合跑一次，快取的版本只量命中的情況
+        for args in CASES:
+            func(args)
+        cases = itertools.cycle(CASES)
+        seconds = timeit.timeit(lambda: func(next(cases)), number=number)
+        print(f"{name:10s} {seconds / number * 1e6:8.1f} us/card")
+    print(progress_card.render.cache_info())
+
+
+if __name__ == "__main__":
+    main()
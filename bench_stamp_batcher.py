@@ -0,0 +1,127 @@
+"""
+集點批次送出的效能比較
+用本機的假後端模擬 Render 上的後端: 每個請求處理 LATENCY 秒，同時最多處理 SERVER_WORKERS 個請求
+每一次集點是一個 webhook 事件 (不同使用者)，跟 main.py 一樣交給 event_worker 處理
+    direct: handler 直接呼叫 backend.add_stamp (原本的作法)
+    batch endpoint: handler 呼叫 stamp_batcher，一批集點合併成一個請求 (STAMP_BATCH_PATH)
+
+handler 要等集點結果才能回覆，一批最多只有 EVENT_WORKERS 筆，所以分別量不同的 worker 數量
+
+執行: python bench_stamp_batcher.py
+
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import event_worker
+from backend_client import BackendClient
+from stamp_batcher import StampBatcher
+
+LATENCY = 0.05
+SERVER_WORKERS = 10
+TAPS = [50, 100, 200, 500]
+WORKERS = [4, 16, 64]
+BATCH_PATH = "/add/batch"
+
+
+class FakeBackend(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # 回應的標頭和內容分兩次寫出，不關掉 Nagle 會碰上 delayed ACK 多等 40 ms
+    disable_nagle_algorithm = True
+    slots = threading.Semaphore(SERVER_WORKERS)
+    requests = 0
+
+    def _reply(self, data: dict):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        with self.slots:
+            FakeBackend.requests += 1
+            time.sleep(LATENCY)
+        if self.path == BATCH_PATH:
+            results = [{"status": 200, s["kind"]: 1} for s in payload["stamps"]]
+            self._reply({"results": results})
+        else:
+            self._reply({self.path.rsplit("/", 1)[-1]: 1})
+
+    do_PUT = _handle
+    do_POST = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server() -> ThreadingHTTPServer:
+    ThreadingHTTPServer.request_queue_size = 1024
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeBackend)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# taps 個使用者同時集點，每個集點是一個事件，回傳全部處理完花費的秒數
+def run(client, taps: int, workers: int) -> float:
+    done = threading.Semaphore(0)
+    errors = []
+
+    def dispatch(event):
+        i = event
+        try:
+            response = client.add_stamp("healthMeasurement", f"U{i}", f"key-{i}")
+            if response.status_code != 200:
+                errors.append(response.status_code)
+        finally:
+            done.release()
+
+    os.environ["EVENT_WORKERS"] = str(workers)
+    event_worker.init(dispatch)
+    began = time.perf_counter()
+    for i in range(taps):
+        event_worker.submit(i, f"U{i}")
+    for _ in range(taps):
+        done.acquire()
+    seconds = time.perf_counter() - began
+    event_worker.shutdown()
+    if errors:
+        raise RuntimeError(f"{len(errors)} stamps failed")
+    return seconds
+
+
+def main():
+    # 連線池滿了時 urllib3 會對每條多出來的連線印警告
+    logging.getLogger("urllib3").setLevel(logging.ERROR)
+    server = start_server()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    variants = [
+        ("direct", lambda backend: backend),
+        ("batch endpoint", lambda backend: StampBatcher(backend, batch_path=BATCH_PATH)),
+    ]
+    print(f"backend: {LATENCY * 1000:.0f} ms/request, {SERVER_WORKERS} workers")
+    for workers in WORKERS:
+        for taps in TAPS:
+            for name, make in variants:
+                client = make(BackendClient(base_url))
+                FakeBackend.requests = 0
+                seconds = run(client, taps, workers)
+                print(
+                    f"EVENT_WORKERS={workers:<3d} {taps:4d} taps  {name:15s} "
+                    f"{seconds:6.2f} s  {taps / seconds:6.0f} taps/s  "
+                    f"{FakeBackend.requests:4d} requests"
+                )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
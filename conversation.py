@@ -0,0 +1,257 @@
+"""
+對話流程的共用部分，main.py (Flask) 和 async_app.py (aiohttp) 都使用這個模組
+這裡只處理不需要 I/O 的部分: 步驟的轉換、格式檢查、回覆的內容、集點要不要記到離線佇列
+呼叫後端和寫入使用者資料由各自的 app 完成 (同步或非同步)
+
+next_step() 依使用者輸入修改 user_info，回傳要回覆的訊息和需要呼叫後端的動作:
+    None       不用呼叫後端
+    "stamp"    集點 (量血壓)
+    "progress" 查詢集點進度
+    "link"     用輸入的身分證字號連結 LINE 帳號
+    "login"    新會員確認資料後，查詢身分證字號並連結 LINE 帳號
+
+"""
+
+import re
+import time
+
+from linebot.v3.messaging import (
+    ButtonsTemplate,
+    PostbackAction,
+    TemplateMessage,
+    TextMessage,
+)
+
+import progress_card
+import stamp_counters
+import templates
+from backend_client import idempotency_supported
+
+# 離線佇列先記下集點時的回覆
+QUEUED_STAMP_TEXT = "系統忙碌中，這次集點已先記下，稍後會自動補登，不用再按一次喔"
+STAMP_FAILED_TEXT = "集點失敗！請稍後嘗試!"
+PROGRESS_FAILED_TEXT = "查詢集點進度失敗！請稍後嘗試!"
+CONTACT_ADMIN_TEXT = "請聯絡管理員"
+
+# postback 的 data -> 集點項目
+POSTBACK_KINDS = {
+    "monitor": "healthMeasurement",
+    "educate": "healthEducation",
+    "exercise": "exercise",
+}
+
+
+# 檢查身分證字號格式
+def check_id_number(idNumber) -> bool:
+    return re.match(r"^[A-Za-z]\d{9}$", idNumber)
+
+
+# 檢查電話號碼格式
+def check_tel(tel) -> bool:
+    return re.match(r"\d{10}", tel)
+
+
+def createUserInfo(userid: str):
+    info = {
+        "user_id": userid,
+        "name": None,
+        "idNumber": None,
+        "tel": None,
+        "steptype": None,
+        "step": 0,
+        "errcount": 0,
+        "register": False,
+    }
+    return info
+
+
+# 完成或取消步驟後，重設步驟狀態
+def reset_steps(user_info: dict):
+    user_info["steptype"] = None
+    user_info["step"] = 0
+    user_info["errcount"] = 0
+
+
+# 根據前一次的操作，分派訊息到對應的處理流程，回傳 (要回覆的訊息, 要呼叫後端的動作)
+def next_step(message: str, user_info: dict):
+    msg_list = []
+
+    # 使用者沒有前一個步驟
+    if user_info["steptype"] == None:
+        if message == "新會員":
+            user_info["step"] = 1
+            user_info["steptype"] = "新會員"
+            msg_list.append(TextMessage(text="請輸入姓名"))
+        elif message == "連結LINE集點" or message == "登入":
+            user_info["step"] = 1
+            user_info["steptype"] = "連結LINEID"
+            msg_list.append(TextMessage(text="請輸入身分證字號"))
+        elif message == "集點":
+            return msg_list, "stamp"
+        elif message == "所有集點":
+            msg_list.append(templates.get("operation_options"))
+        elif message == "集點進度" and stamp_counters.enabled():
+            return msg_list, "progress"
+
+    elif user_info["steptype"] == "連結LINEID":
+        if check_id_number(message):
+            return msg_list, "link"
+        user_info["errcount"] += 1
+        reply_text = "身分證字號格式錯誤，請輸入有效的身分證字號（1個字母 + 9個數字）"
+        msg_list.append(TextMessage(text=reply_text))
+
+    elif user_info["steptype"] == "新會員":
+        if user_info["step"] == 1:
+            user_info["step"] = 2
+            user_info["name"] = message
+            msg_list.append(TextMessage(text="請輸入身分證字號"))
+        elif user_info["step"] == 2:
+            if check_id_number(message):
+                user_info["idNumber"] = message
+                user_info["step"] = 3
+                msg_list.append(TextMessage(text="請輸入電話號碼"))
+            else:
+                user_info["errcount"] += 1
+                msg_list.append(
+                    TextMessage(text="格式錯誤！請輸入 1 個英文字母和 9 個數字。")
+                )
+        elif user_info["step"] == 3:
+            user_info["tel"] = message
+            user_info["step"] = 4
+            msg_list.append(confirm_message(user_info))
+        elif user_info["step"] == 4:
+            if check_id_number(message):
+                user_info["idNumber"] = message
+                return msg_list, "login"
+            user_info["errcount"] += 1
+            msg_list.append(TextMessage(text="登入步驟錯誤或身分證字號格式錯誤"))
+
+    return msg_list, None
+
+
+# 請使用者確認輸入的註冊資料
+def confirm_message(user_info: dict) -> TemplateMessage:
+    buttons_template = ButtonsTemplate(
+        title="請確認您的資料",
+        text=(
+            f"您的姓名是 {user_info['name']}、\n"
+            f"身份證字號是 {user_info['idNumber']}、\n"
+            f"電話是 {user_info['tel']}。\n請問是否正確？"
+        ),
+        actions=[
+            PostbackAction(label="是", data="correct"),
+            PostbackAction(label="否", data="incorrect"),
+        ],
+    )
+    return TemplateMessage(alt_text="確認資料", template=buttons_template)
+
+
+# 資料不正確，從輸入姓名重新開始
+def restart_registration(userid: str) -> dict:
+    user_info = createUserInfo(userid)
+    user_info["steptype"] = "新會員"
+    user_info["step"] = 1
+    return user_info
+
+
+# 輸入身分證字號連結帳號的結果 (status_code 是 None 表示請求失敗)，連結成功時標記為會員
+def link_reply(user_info: dict, status_code: int, detail: str = None) -> str:
+    if status_code == 200:
+        # 已經是會員 (註冊不一定是透過 bot)，提醒排程用來找出會員
+        user_info["linked"] = True
+        return "連結成功"
+    if status_code == 400:
+        return detail
+    if status_code is None:
+        return CONTACT_ADMIN_TEXT
+    return "重複連結或錯誤，請確認!"
+
+
+# 登出時清掉步驟和連結狀態，點數屬於登出的會員，下次登入後重新向後端查詢
+def logged_out(user_info: dict):
+    reset_steps(user_info)
+    user_info["linked"] = False
+    for kind in progress_card.CARDS:
+        user_info[f"{kind}_count"] = None
+    stamp_counters.invalidate(user_info["user_id"])
+
+
+# 集點沒有成功時，要不要先記到離線佇列由背景補送
+# 確定沒送到後端 (斷路器打開、連不上) 時記下；讀取逾時、429、5xx 時後端可能已經集點，
+# 只有後端支援 Idempotency-Key 時才記下；其他狀態碼是後端拒絕，不記
+def should_journal(status_code: int = None, not_sent: bool = False) -> bool:
+    if not_sent:
+        return True
+    if status_code is not None and status_code < 500 and status_code != 429:
+        return False
+    return idempotency_supported()
+
+
+# 集點成功，把點數和時間記在使用者資料內 (提醒排程用來找出這週還沒集點的會員)，回傳點數
+def stamped(user_info: dict, kind: str, count: int) -> int:
+    user_info[f"{kind}_count"] = count
+    user_info[f"{kind}_at"] = time.time()
+    stamp_counters.update(user_info["user_id"], kind, count)
+    return count
+
+
+# 集點記到離線佇列，點數用上次的點數加一暫代
+# 不知道上次的點數 (例如登出後、新的使用者) 時回傳 None，不顯示猜測的點數
+def journaled(user_info: dict, kind: str):
+    count = user_info.get(f"{kind}_count")
+    if count is not None:
+        count += 1
+    user_info[f"{kind}_count"] = count
+    user_info[f"{kind}_at"] = time.time()
+    # 暫存的點數還沒經過後端確認，這一項下次查看進度時重新向後端查詢
+    stamp_counters.forget(user_info["user_id"], kind)
+    return count
+
+
+# 進度卡片的說明文字，暫存的點數還沒經過後端確認
+def progress_msg(queued: bool) -> str:
+    return "暫存的集點進度" if queued else "目前集點進度"
+
+
+# 輸入「集點」的回覆，count 和 queued 是 add_stamp 的結果
+def text_stamp_messages(count: int, queued: bool) -> list:
+    if count is None:
+        return [TextMessage(text=QUEUED_STAMP_TEXT if queued else STAMP_FAILED_TEXT)]
+    max = progress_card.CARDS["healthMeasurement"][1]
+    if queued:
+        reply_text = QUEUED_STAMP_TEXT
+    elif count < max:
+        reply_text = "集點成功，加油!!"
+    elif count == max:
+        reply_text = "集滿囉!!!可以拿給志工確認換禮物囉~"
+    else:
+        reply_text = "有持續量血壓很棒喔~"
+    return [
+        progress_card.render("集點券", progress_msg(queued), count, max),
+        TextMessage(text=reply_text),
+    ]
+
+
+# 集點選單 (postback) 的回覆，附上其他項目選單，生理監測失敗時不附上
+def postback_stamp_messages(kind: str, count: int, queued: bool) -> list:
+    if count is not None:
+        title, max = progress_card.CARDS[kind]
+        msg_list = [
+            progress_card.render(title, progress_msg(queued), count, max),
+            TextMessage(text=QUEUED_STAMP_TEXT if queued else "集點完成"),
+        ]
+    elif queued:
+        msg_list = [TextMessage(text=QUEUED_STAMP_TEXT)]
+    else:
+        msg_list = [TextMessage(text=STAMP_FAILED_TEXT)]
+        if kind == "healthMeasurement":
+            return msg_list
+    msg_list.append(templates.get("other_operation_options"))
+    return msg_list
+
+
+# 集點進度的回覆，counts 是 None 表示向後端查詢失敗
+def progress_messages(counts: dict, stale=()) -> list:
+    if counts is None:
+        return [TextMessage(text=PROGRESS_FAILED_TEXT)]
+    return stamp_counters.cards(counts, stale)
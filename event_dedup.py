@@ -0,0 +1,78 @@
+"""
+webhook 事件去重模組
+LINE 重送 webhook 時 webhookEventId 不會變，收過的 id 在時間窗內再出現就直接丟掉
+避免重送的「集點」訊息或集點 postback 讓後端多加一次點數
+
+環境變數:
+    DEDUP_WINDOW     記住事件 id 的秒數，預設 600
+    DEDUP_MAX        最多記住幾個事件 id，預設 10000
+    DEDUP_PERSISTENT 設成 true 時另外透過 persistence 記錄，多個 worker / 重新啟動後也能去重
+
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import persistence as db
+
+# 定義全域變數
+window = float(os.getenv("DEDUP_WINDOW", "600"))
+max_size = int(os.getenv("DEDUP_MAX", "10000"))
+persistent = os.getenv("DEDUP_PERSISTENT", "false").lower() == "true"
+
+# 事件 id -> 收到的時間，依收到的先後排序
+_seen = OrderedDict()
+_lock = threading.Lock()
+_dropped = 0
+
+
+def _expire(now: float):
+    while _seen:
+        event_id, received = next(iter(_seen.items()))
+        if now - received < window and len(_seen) <= max_size:
+            break
+        del _seen[event_id]
+
+
+# 記錄事件 id，第一次看到回傳 True，重複的回傳 False
+def add(event_id: str) -> bool:
+    global _dropped
+    if not event_id:
+        return True
+    now = time.monotonic()
+    with _lock:
+        _expire(now)
+        if event_id in _seen:
+            _dropped += 1
+            return False
+        _seen[event_id] = now
+        return True
+
+
+# 事件沒有成功放進佇列時要移除，LINE 重送時才會再處理
+def discard(event_id: str):
+    with _lock:
+        _seen.pop(event_id, None)
+
+
+# 跨 worker 的檢查，會多一次資料庫存取，在背景 worker 內呼叫
+def add_persistent(event_id: str) -> bool:
+    global _dropped
+    if not persistent or not event_id:
+        return True
+    if db.mark_event(event_id, window):
+        return True
+    with _lock:
+        _dropped += 1
+    return False
+
+
+def stats() -> dict:
+    return {
+        "size": len(_seen),
+        "window": window,
+        "persistent": persistent,
+        "dropped": _dropped,
+    }
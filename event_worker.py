@@ -0,0 +1,293 @@
+"""
+背景事件處理模組
+webhook 收到事件後只負責驗證簽章並放進佇列，馬上回 200 給 LINE
+真正的處理 (handle_message / handle_postback / handle_follow) 由背景的 worker 執行緒完成
+
+同一個使用者的事件依收到的順序一個一個處理，不會同時修改同一份使用者資料
+不同使用者的事件由不同的 worker 同時處理
+每個使用者有自己的信箱 (mailbox)，有事件要處理的使用者排在 ready 佇列等 worker 來拿
+
+LINE 一次 webhook 可能帶好幾個事件 (一次遞送，delivery)，用 submit_delivery 一起放入
+事件都會馬上放進各自的信箱，同一個使用者的事件不管屬於哪一次遞送都依收到的順序處理
+同一次遞送同時處理的事件有上限，worker 取出時已經到上限的話，這個信箱先等這次遞送有事件處理完
+統計每次遞送從第一個事件開始處理到全部處理完的時間，和各事件處理時間的總和，比較平行處理省下多少時間
+收到之後到開始處理前在佇列等待的時間另外統計，不算在處理時間內
+
+環境變數:
+    EVENT_WORKERS       worker 執行緒數量，預設 4
+    EVENT_QUEUE_SIZE    等待處理的事件上限，預設 1000，滿了 submit 會回傳 False
+    EVENT_DRAIN_TIMEOUT 結束時等待佇列清空的秒數，預設 10
+    EVENT_DELIVERY_CONCURRENCY 同一次遞送最多同時處理幾個事件，預設 8
+
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# 定義全域變數
+_threads = []
+_dispatch = None
+_pid = None
+_lock = threading.Lock()
+_cond = threading.Condition(_lock)
+_stopping = False
+_stopped = False
+
+# key -> 等待處理的 (事件, 放入時間, 所屬的遞送)，正在處理的 key 也會留在這裡 (可能是空的)
+_mailboxes = {}
+# 輪到可以處理的 key
+_ready = deque()
+_pending = 0
+_running = 0
+
+# 排隊等待時間的統計
+_wait_count = 0
+_wait_total = 0.0
+_wait_max = 0.0
+
+# 遞送的統計
+_deliveries = 0
+_delivery_events = 0
+_delivery_wall = 0.0
+_delivery_wall_max = 0.0
+_delivery_handler = 0.0
+_delivery_wait = 0.0
+
+
+# 一次 webhook 遞送的事件
+class _Delivery:
+    def __init__(self, size: int):
+        self.size = size
+        self.remaining = size
+        self.in_flight = 0
+        # 下一個事件屬於這次遞送、但同時處理的數量已經到上限的 key
+        self.waiting = deque()
+        self.received = time.monotonic()
+        # 第一個事件開始處理的時間
+        self.started = None
+        self.handler_time = 0.0
+
+
+def _worker_count() -> int:
+    return max(1, int(os.getenv("EVENT_WORKERS", "4")))
+
+
+def _queue_size() -> int:
+    return max(1, int(os.getenv("EVENT_QUEUE_SIZE", "1000")))
+
+
+def _delivery_concurrency() -> int:
+    return max(1, int(os.getenv("EVENT_DELIVERY_CONCURRENCY", "8")))
+
+
+# 取出下一個可以處理的 (key, 事件, 放入時間, 所屬的遞送)，呼叫時要持有 _lock
+# 停止時沒有事件可以處理就回傳 None
+def _take():
+    while True:
+        while not _ready and not _stopped:
+            _cond.wait()
+        if not _ready:
+            return None
+        key = _ready.popleft()
+        mailbox = _mailboxes[key]
+        event, enqueued, delivery = mailbox[0]
+        if delivery.in_flight >= _delivery_concurrency():
+            # 先不處理這個使用者，等這次遞送有事件處理完再排回 ready 佇列
+            delivery.waiting.append(key)
+            continue
+        mailbox.popleft()
+        delivery.in_flight += 1
+        if delivery.started is None:
+            delivery.started = time.monotonic()
+        return key, event, enqueued, delivery
+
+
+# 一個事件處理完，讓同一次遞送中等待的信箱回到 ready 佇列，全部處理完時記錄統計，呼叫時要持有 _lock
+def _finish(delivery: _Delivery, elapsed: float):
+    global _deliveries, _delivery_events, _delivery_wall, _delivery_wall_max
+    global _delivery_handler, _delivery_wait
+    delivery.handler_time += elapsed
+    delivery.in_flight -= 1
+    delivery.remaining -= 1
+    if delivery.waiting:
+        _ready.append(delivery.waiting.popleft())
+    if delivery.remaining == 0:
+        wall = time.monotonic() - delivery.started
+        _deliveries += 1
+        _delivery_events += delivery.size
+        _delivery_wall += wall
+        _delivery_wall_max = max(_delivery_wall_max, wall)
+        _delivery_handler += delivery.handler_time
+        _delivery_wait += delivery.started - delivery.received
+
+
+# worker 執行緒的主迴圈
+def _run():
+    global _pending, _running, _wait_count, _wait_total, _wait_max
+    while True:
+        with _cond:
+            taken = _take()
+            if taken is None:
+                return
+            key, event, enqueued, delivery = taken
+            _pending -= 1
+            _running += 1
+            wait = time.monotonic() - enqueued
+            _wait_count += 1
+            _wait_total += wait
+            _wait_max = max(_wait_max, wait)
+        started = time.monotonic()
+        try:
+            _dispatch(event)
+        except Exception as e:
+            logger.exception(f"Error while handling event: {e}")
+        finally:
+            with _cond:
+                _running -= 1
+                _finish(delivery, time.monotonic() - started)
+                if _mailboxes[key]:
+                    # 同一個使用者還有事件，排到 ready 佇列的最後面，讓其他使用者先處理
+                    _ready.append(key)
+                else:
+                    del _mailboxes[key]
+                _cond.notify_all()
+
+
+# 設定分派函式，真正啟動執行緒會延後到第一次 submit
+# gunicorn 會在 import 之後才 fork，執行緒要在 fork 之後的子行程內建立
+def init(dispatch):
+    global _dispatch
+    _dispatch = dispatch
+
+
+def _ensure_started():
+    global _threads, _pid, _stopping, _stopped, _mailboxes, _ready, _pending, _running
+    if _pid == os.getpid():
+        return
+    with _lock:
+        if _pid == os.getpid():
+            return
+        _mailboxes = {}
+        _ready = deque()
+        _pending = 0
+        _running = 0
+        _threads = []
+        _stopping = False
+        _stopped = False
+        for i in range(_worker_count()):
+            t = threading.Thread(target=_run, name=f"event-worker-{i}", daemon=True)
+            t.start()
+            _threads.append(t)
+        _pid = os.getpid()
+
+
+# 放入一個事件，key 相同的事件會依序處理，None 表示不需要排序
+# 佇列滿了或正在關閉時回傳 False
+def submit(event, key=None) -> bool:
+    return submit_delivery([(event, key)])
+
+
+# 放入同一次 webhook 遞送的 (事件, key)，要嘛全部放入，要嘛全部不放
+# 佇列放不下或正在關閉時回傳 False
+def submit_delivery(items) -> bool:
+    global _pending
+    if _dispatch is None:
+        raise RuntimeError("event_worker.init() has not been called")
+    if not items:
+        return True
+    _ensure_started()
+    with _cond:
+        if _stopping:
+            return False
+        if _pending + len(items) > _queue_size():
+            logger.warning(f"Event queue is full, dropping {len(items)} events")
+            return False
+        _pending += len(items)
+        delivery = _Delivery(len(items))
+        now = time.monotonic()
+        for event, key in items:
+            if key is None:
+                key = object()
+            mailbox = _mailboxes.get(key)
+            if mailbox is None:
+                mailbox = _mailboxes[key] = deque()
+                _ready.append(key)
+            mailbox.append((event, now, delivery))
+        _cond.notify_all()
+    return True
+
+
+# 目前佇列中等待處理的事件數
+def queue_depth() -> int:
+    if _pid != os.getpid():
+        return 0
+    return _pending
+
+
+def stats() -> dict:
+    if _pid != os.getpid():
+        return {"queue_depth": 0, "queue_size": _queue_size(), "workers": 0}
+    with _lock:
+        return {
+            "queue_depth": _pending,
+            "queue_size": _queue_size(),
+            "workers": len(_threads),
+            "running": _running,
+            "active_users": len(_mailboxes),
+            "longest_mailbox": max((len(m) for m in _mailboxes.values()), default=0),
+            "wait_avg_ms": _wait_total / _wait_count * 1000 if _wait_count else 0.0,
+            "wait_max_ms": _wait_max * 1000,
+            "delivery_concurrency": _delivery_concurrency(),
+            "deliveries": _deliveries,
+            "delivery_events_avg": (
+                _delivery_events / _deliveries if _deliveries else 0.0
+            ),
+            # 收到之後等第一個事件開始處理的時間
+            "delivery_wait_avg_ms": (
+                _delivery_wait / _deliveries * 1000 if _deliveries else 0.0
+            ),
+            # 從第一個事件開始處理到全部處理完的時間，和各事件處理時間總和的平均
+            "delivery_wall_avg_ms": (
+                _delivery_wall / _deliveries * 1000 if _deliveries else 0.0
+            ),
+            "delivery_wall_max_ms": _delivery_wall_max * 1000,
+            "delivery_handler_avg_ms": (
+                _delivery_handler / _deliveries * 1000 if _deliveries else 0.0
+            ),
+            # 大於 1 表示平行處理比一個一個處理快
+            "delivery_speedup": (
+                _delivery_handler / _delivery_wall if _delivery_wall else 0.0
+            ),
+        }
+
+
+# 停止接收新事件，等佇列內的事件處理完再結束 worker
+def shutdown(timeout: float = None):
+    global _stopping, _stopped, _pid
+    if _pid != os.getpid():
+        return
+    if timeout is None:
+        timeout = float(os.getenv("EVENT_DRAIN_TIMEOUT", "10"))
+    deadline = time.monotonic() + timeout
+    with _cond:
+        _stopping = True
+        while _pending or _running:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning(f"Event queue not drained, {_pending} events left")
+                break
+            _cond.wait(remaining)
+        _stopped = True
+        _cond.notify_all()
+    for t in _threads:
+        t.join(max(0, deadline - time.monotonic()))
+    _pid = None
+
+
+atexit.register(shutdown)
@@ -0,0 +1,40 @@
+"""
+背景工作的負責 worker 選擇
+同一台主機上的多個 gunicorn worker 用檔案鎖 (flock) 選出一個負責，例如送出提醒、補送集點
+拿到鎖的 worker 一直持有到行程結束，當掉時系統會釋放鎖，其他 worker 下一次嘗試時接手
+
+"""
+
+import fcntl
+import os
+import threading
+
+
+class LeaderLock:
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    # 不等待，拿到鎖 (或之前已經拿到) 時回傳 True
+    def acquire(self) -> bool:
+        with self._lock:
+            if self._pid != os.getpid():
+                # 從已經拿到鎖的行程 fork 出來時，鎖屬於父行程，子行程要自己重新取得
+                self._file = None
+                self._pid = os.getpid()
+            if self._file is not None:
+                return True
+            f = open(self.path, "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                return False
+            self._file = f
+            return True
+
+    # 這個行程是不是負責的 worker
+    def held(self) -> bool:
+        return self._file is not None and self._pid == os.getpid()
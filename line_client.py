@@ -0,0 +1,60 @@
+"""
+LINE Messaging API 的共用連線模組
+每個 worker 行程只建立一個 ApiClient / MessagingApi，回覆跟推播都共用同一個 urllib3 連線池
+不用每個事件都重新連線到 api.line.me
+
+環境變數:
+    LINE_POOL_MAXSIZE 連線池大小，預設用 SDK 的設定 (CPU 數 x 5)
+
+"""
+
+import atexit
+import os
+import threading
+
+from linebot.v3.messaging import ApiClient, MessagingApi
+
+# 定義全域變數
+_configuration = None
+_api_client = None
+_messaging_api = None
+_pid = None
+_lock = threading.Lock()
+
+
+# 設定連線參數，真正建立連線會延後到第一次使用 (gunicorn fork 之後)
+def init(configuration):
+    global _configuration
+    pool_maxsize = os.getenv("LINE_POOL_MAXSIZE")
+    if pool_maxsize:
+        configuration.connection_pool_maxsize = int(pool_maxsize)
+    _configuration = configuration
+
+
+# 取得這個行程共用的 MessagingApi，可以在多個執行緒同時使用
+def get_messaging_api() -> MessagingApi:
+    global _api_client, _messaging_api, _pid
+    if _pid != os.getpid():
+        if _configuration is None:
+            raise RuntimeError("line_client.init() has not been called")
+        with _lock:
+            if _pid != os.getpid():
+                # fork 前父行程的連線池不能沿用，直接建新的
+                _api_client = ApiClient(_configuration)
+                _messaging_api = MessagingApi(_api_client)
+                _pid = os.getpid()
+    return _messaging_api
+
+
+# 關閉連線池
+def close():
+    global _api_client, _messaging_api, _pid
+    with _lock:
+        if _api_client is not None and _pid == os.getpid():
+            _api_client.close()
+        _api_client = None
+        _messaging_api = None
+        _pid = None
+
+
+atexit.register(close)
@@ -3,17 +3,7 @@ from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (
     Configuration,
-    ApiClient,
-    MessagingApi,
-    ReplyMessageRequest,
-    MessageAction,
     TextMessage,
-    FlexMessage,
-    FlexContainer,
-    TemplateMessage,
-    ButtonsTemplate,
-    PostbackAction,
-    PushMessageRequest,
 )
 
 from linebot.v3.webhooks import (
@@ -26,13 +16,29 @@ from linebot.v3.webhooks import (
 
 
 from linebot.exceptions import LineBotApiError
-import re
-import requests
 from dotenv import load_dotenv
 import os
 import json
 import random
+import requests
 import persistence as db
+import line_client
+# push_queue 要在 event_worker 之前 import，結束時 (atexit) 才會先等事件處理完再送出剩下的推播
+import push_queue
+import event_worker
+import event_dedup
+import templates
+import message_composer
+import conversation
+import reminders
+import stamp_journal
+import stamp_batcher
+import stamp_counters
+from backend_client import (
+    BackendClient,
+    CircuitOpenError,
+    not_sent,
+)
 
 from flask_cors import CORS
 
@@ -62,147 +68,17 @@ secret = os.getenv("SECRET")
 
 configuration = Configuration(access_token=access_token)
 handler = WebhookHandler(secret)
+line_client.init(configuration)
 
 BASE_URL = "https://test-1-pwmo.onrender.com"
 
-def build_url(path: str) -> str:
-    return f"{BASE_URL}{path}"
+backend = BackendClient(BASE_URL)
+# 後端有批次 endpoint (STAMP_BATCH_PATH) 時，同時進來的集點合併成一個請求，用法跟 backend.add_stamp 一樣
+stamp_client = stamp_batcher.StampBatcher(backend) if stamp_batcher.enabled() else None
 
 # 建立操作提示選項
 def create_operation_options():
-    buttons_template = ButtonsTemplate(
-        title="請問你要進行什麼操作？",
-        text="請點擊以下選項",
-        actions=[
-            PostbackAction(label="開始集點", data="start"),
-            PostbackAction(label="不需要操作", data="logout"),
-        ],
-    )
-
-    template_message = TemplateMessage(
-        alt_text="請問你要進行什麼操作？", template=buttons_template
-    )
-    return template_message
-
-
-# 產生進度條
-def progress_bar(title: str, msg: str, current: int, max: int) -> str:
-    # 計算進度條的長度
-    progress = int(float(current) / float(max) * 100)
-    if progress > 100:
-        progress = 100
-
-    # 定義 Flex Message 的 JSON 格式
-    data = {
-        "type": "carousel",
-        "contents": [
-            {
-                "type": "bubble",
-                "size": "kilo",
-                "header": {
-                    "type": "box",
-                    "layout": "vertical",
-                    "backgroundColor": "#27ACB2",
-                    "paddingTop": "19px",
-                    "paddingAll": "12px",
-                    "paddingBottom": "16px",
-                    "contents": [
-                        {
-                            "type": "text",
-                            "text": title,
-                            "color": "#FFFFFF",
-                            "size": "md",
-                            "align": "start",
-                            "gravity": "center",
-                        },
-                        {
-                            "type": "text",
-                            "text": str(current) + "/" + str(max),
-                            "color": "#ffffff",
-                            "align": "start",
-                            "size": "xs",
-                            "gravity": "center",
-                            "margin": "lg",
-                        },
-                        {
-                            "type": "box",
-                            "layout": "vertical",
-                            "contents": [
-                                {
-                                    "type": "box",
-                                    "layout": "vertical",
-                                    "contents": [{"type": "filler"}],
-                                    "width": str(progress) + "%",
-                                    "backgroundColor": "#0D8186",
-                                    "height": "8px",
-                                }
-                            ],
-                            "backgroundColor": "#9FD8E3A0",
-                            "height": "8px",
-                            "margin": "sm",
-                        },
-                    ],
-                },
-                "body": {
-                    "type": "box",
-                    "layout": "vertical",
-                    "flex": 1,
-                    "contents": [
-                        {
-                            "type": "text",
-                            "text": msg,
-                            "color": "#8C8C8C",
-                            "size": "sm",
-                            "wrap": True,
-                        }
-                    ],
-                },
-                "styles": {"footer": {"separator": False}},
-            }
-        ],
-    }
-
-    return data
-
-
-# 主動推送訊息給使用者
-def send_operation_options(line_bot_api, user_id):
-    print(user_id)
-    buttons_template = ButtonsTemplate(
-        title="請問你要進行什麼操作？",
-        text="請點擊以下選項",
-        actions=[
-            PostbackAction(label="開始集點", data="start"),
-            PostbackAction(label="不需要操作", data="logout"),
-        ],
-    )
-
-    template_message = TemplateMessage(
-        alt_text="請問你要進行什麼操作？", template=buttons_template
-    )
-    line_bot_api.push_message_with_http_info(
-        PushMessageRequest(to=user_id, messages=[template_message])
-    )
-
-
-# 主動推送訊息給使用者
-def send_other_operation_options(line_bot_api, user_id):
-    buttons_template = ButtonsTemplate(
-        title="請問你還需要處理其他項目嗎？",
-        text="請點擊以下選項",
-        actions=[
-            PostbackAction(label="生理監測", data="monitor"),
-            PostbackAction(label="AI衛教", data="educate"),
-            PostbackAction(label="運動", data="exercise"),
-            PostbackAction(label="登出", data="logout"),
-        ],
-    )
-    template_message = TemplateMessage(
-        alt_text="請問你還需要處理其他項目嗎？", template=buttons_template
-    )
-    line_bot_api.push_message_with_http_info(
-        PushMessageRequest(to=user_id, messages=[template_message])
-    )
+    return templates.get("operation_options")
 
 
 @app.route(webhook, methods=["POST"])
@@ -215,54 +91,185 @@ def linebot():
     body = request.get_data(as_text=True)
     app.logger.info("Request body: " + body)
 
-    # handle webhook body
+    # 只驗證簽章並解析事件，處理交給背景 worker，先回 200 給 LINE
     try:
-        handler.handle(body, signature)
+        events = handler.parser.parse(body, signature)
+    except InvalidSignatureError:
+        abort(400)
     except Exception as e:
         app.logger.error(f"Error: {e}")
+        return "OK"
+
+    items = []
+    for event in events:
+        # LINE 重送的事件 id 不變，已經收過就直接丟掉
+        if not event_dedup.add(event.webhook_event_id):
+            app.logger.info(f"Drop duplicated event {event.webhook_event_id}")
+            continue
+        items.append((event, getattr(event.source, "user_id", None)))
+
+    # 同一個使用者的事件依序處理，不同使用者同時處理
+    if not event_worker.submit_delivery(items):
+        # 佇列滿了，回 503 讓 LINE 之後重送整批事件
+        for event, _ in items:
+            event_dedup.discard(event.webhook_event_id)
+        abort(503)
 
     return "OK"
 
 
-# 檢查身分證字號格式
-def check_id_number(idNumber) -> bool:
-    return re.match(r"^[A-Za-z]\d{9}$", idNumber)
-
+# 使用者資料更新衝突時最多重新處理幾次
+conflict_retries = int(os.getenv("CONFLICT_RETRIES", "3"))
+
+
+# 依事件型別找到對應的 handler 並執行，在背景 worker 執行緒內呼叫
+def dispatch_event(event):
+    if not event_dedup.add_persistent(event.webhook_event_id):
+        app.logger.info(f"Drop duplicated event {event.webhook_event_id}")
+        return
+    func = None
+    if isinstance(event, MessageEvent):
+        func = handler._handlers.get(
+            f"{event.__class__.__name__}_{event.message.__class__.__name__}")
+    if func is None:
+        func = handler._handlers.get(event.__class__.__name__)
+    if func is None:
+        func = handler._default
+    if func is None:
+        app.logger.info(f"No handler of {event.__class__.__name__}")
+        return
+    # 同一個事件內對使用者資料的多次更新，結束時合併成一次寫入
+    # 資料被其他 worker 改過 (version 對不上) 時重新讀取再處理一次
+    # 已經呼叫過不能重複的後端 API (call_once) 的事件不會重新處理，寫入時改成合併最新的資料
+    # 回覆訊息等使用者資料寫入之後才送出，衝突重新處理時不會重複回覆
+    user_id = getattr(event.source, "user_id", None)
+    for attempt in range(conflict_retries + 1):
+        try:
+            with message_composer.compose(
+                getattr(event, "reply_token", None), user_id, event.timestamp
+            ) as composer:
+                with db.unit_of_work(user_id):
+                    func(event)
+                composer.send()
+            return
+        except db.ConflictError as e:
+            app.logger.warning(f"Retry event after conflict: {e}")
+    app.logger.error(f"Give up event {event.webhook_event_id} after conflicts")
+
+
+event_worker.init(dispatch_event)
+
+
+# 提醒排程和集點補送的執行緒要在 gunicorn fork 之後的 worker 內啟動
+@app.before_request
+def start_background_jobs():
+    reminders.start()
+    stamp_journal.start(backend)
+
+
+@app.route("/status", methods=["GET"])
+def status():
+    return {
+        "event_worker": event_worker.stats(),
+        "backend": backend.stats(),
+        "dedup": event_dedup.stats(),
+        "messages": message_composer.stats(),
+        "push": push_queue.stats(),
+        "reminders": reminders.stats(),
+        "stamp_journal": stamp_journal.stats(),
+        "stamp_batcher": stamp_client.stats() if stamp_client else None,
+        "stamp_counters": stamp_counters.stats(),
+        "cache": db.cache_stats(),
+        "memory_store": db.store_stats(),
+    }
 
-# 檢查電話號碼格式
-def check_tel(tel) -> bool:
-    return re.match(r"\d{10}", tel)
 
 def check_member(lineId) -> bool:
-    url = build_url("/searchLineID/")
     try:
-        response = requests.post(
-            url,
-            json={"lineId": lineId},
-        )
+        response = backend.search_line_id(lineId)
         return response.status_code == 200
     except Exception as e:
         print(f"Error during request: {e}")
         return False
 
 
+# 呼叫不能重複的後端 API (集點、註冊、連結帳號)，呼叫之後這個事件不再因為資料衝突重新處理
+# 呼叫前要先在 try 外面呼叫 db.ensure_current()，ConflictError 才不會被當成一般錯誤吃掉
+def call_once(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        db.mark_irreversible()
+
+
+# 集點並回傳 (目前的點數, 是否只先記在離線佇列)，後端拒絕時回傳 (None, False)
+# 記在離線佇列但不知道目前點數時回傳 (None, True)，呼叫端只回覆已記下、不顯示進度卡片
+# 要不要記到離線佇列見 conversation.should_journal
+# event_id 用來產生 Idempotency-Key，同一個事件重新處理時不會重複集點
+def add_stamp(kind: str, user_info: dict, event_id: str = None):
+    key = stamp_journal.idempotency_key(event_id, kind)
+    db.ensure_current()
+    try:
+        response = call_once(
+            (stamp_client or backend).add_stamp,
+            kind,
+            user_info["user_id"],
+            idempotency_key=key,
+        )
+        if response.status_code == 200:
+            count = conversation.stamped(user_info, kind, response.json().get(kind))
+            db.update_data(user_info["user_id"], user_info)
+            return count, False
+        print(f"Stamp {kind} failed: {response.status_code}")
+        journal = conversation.should_journal(response.status_code)
+    except CircuitOpenError:
+        print(f"Stamp {kind} skipped: backend circuit is open")
+        journal = True
+    except requests.RequestException as e:
+        print(f"Error during request: {e}")
+        journal = conversation.should_journal(not_sent=not_sent(e))
+    except Exception as e:
+        print(f"Error during request: {e}")
+        journal = False
+    if not journal:
+        return None, False
+    return journal_stamp(kind, user_info, key)
+
+
+# 後端暫時無法服務，集點先記到離線佇列
+def journal_stamp(kind: str, user_info: dict, key: str):
+    if not stamp_journal.enabled():
+        return None, False
+    try:
+        stamp_journal.record(kind, user_info["user_id"], key)
+    except Exception as e:
+        print(f"Error while journaling stamp: {e}")
+        return None, False
+    count = conversation.journaled(user_info, kind)
+    db.update_data(user_info["user_id"], user_info)
+    return count, True
+
+
+# 不集點，只顯示知道的集點項目的進度卡片，一項都不知道時才等後端查詢
+# 要有後端的查詢 API (stamp_counters.enabled()) 才會呼叫
+def show_progress(user_info: dict) -> list:
+    counts, stale = stamp_counters.lookup(backend, user_info["user_id"], user_info)
+    if not counts:
+        counts = stamp_counters.load(backend, user_info["user_id"])
+    return conversation.progress_messages(counts, stale)
+
+
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_message(event):
 
     user_id = event.source.user_id
 
-    # 查詢使用者資料，取回前一次登入操作的資料
-    qdata = db.query_data(user_id)
-    if qdata is not None:
-        user_info = qdata
-    else:
-        # 沒有就建一個新的使用者資料
-        user_info = createUserInfo(user_id)
-        db.insert_data(user_id, user_info)
+    # 查詢使用者資料，取回前一次登入操作的資料，沒有就建一個新的使用者資料
+    user_info = db.get_or_create(user_id, conversation.createUserInfo(user_id))
 
-    push_message = False
-    msg_list, push_message = dispatch_type(
-        user_id, event.message.text, user_info)
+    msg_list = dispatch_type(
+        user_id, event.message.text, user_info, event.webhook_event_id
+    )
 
     if len(msg_list) <= 0:
         if user_info["register"] == False:
@@ -273,448 +280,130 @@ def handle_message(event):
             msg_list = process_message(
                 event.source.user_id, event.message.text)
 
-    if len(msg_list) > 0:
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            if push_message:
-                line_bot_api.push_message_with_http_info(
-                    PushMessageRequest(to=user_id, messages=msg_list)
-                )
-            else:
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=msg_list,
-                    )
-                )
+    # 事件處理完才送出，reply token 過期時會自動改用 push
+    message_composer.current().add(*msg_list)
     return
 
 
-def createUserInfo(userid: str):
-    info = {
-        "user_id": userid,
-        "name": None,
-        "idNumber": None,
-        "tel": None,
-        "steptype": None,
-        "step": 0,
-        "errcount": 0,
-        "register": False,
-    }
-    return info
-
-
-# 根據前一次的操作，分派訊息到對應的處理流程
-def dispatch_type(user_id: str, message: str, user_info) -> tuple[list, bool]:
-    msg_list = []
-    push_message = False
-
-    # 使用者沒有前一個步驟
-    if user_info["steptype"] == None:
-
-        if message == "新會員":
-            user_info["step"] = 1
-            user_info["steptype"] = "新會員"
-            db.update_data(user_id, user_info)
-            msg_list.append(TextMessage(text="請輸入姓名"))
-        elif message == "連結LINE集點" or message == "登入":
-            user_info["step"] = 1
-            user_info["steptype"] = "連結LINEID"
-            db.update_data(user_id, user_info)
-            msg_list.append(TextMessage(text="請輸入身分證字號"))
-        elif message == "集點":
-            url = build_url("/add/healthMeasurement")
-            response = requests.put(
-                url,
-                json={"lineId": user_info["user_id"]},  # 傳遞的 JSON 資料
-            )
-            print(response.status_code)
+# 根據前一次的操作，分派訊息到對應的處理流程 (見 conversation.next_step)，這裡只負責呼叫後端
+def dispatch_type(user_id: str, message: str, user_info, event_id: str = None) -> list:
+    before = dict(user_info)
+    msg_list, action = conversation.next_step(message, user_info)
+    if user_info != before:
+        db.update_data(user_id, user_info)
+
+    if action == "stamp":
+        count, queued = add_stamp("healthMeasurement", user_info, event_id)
+        msg_list.extend(conversation.text_stamp_messages(count, queued))
+    elif action == "progress":
+        msg_list.extend(show_progress(user_info))
+    elif action == "link":
+        db.ensure_current()
+        try:
+            response = call_once(backend.link_line_id, message, user_id)
             data = response.json()
-            health_measurement = data.get(
-                "healthMeasurement")  # 使用 .get() 確保鍵存在
+            reply_text = conversation.link_reply(
+                user_info, response.status_code, data.get("detail")
+            )
+        except Exception as e:
+            print(f"Error during request: {e}")
+            reply_text = conversation.link_reply(user_info, None)
+        msg_list.append(TextMessage(text=reply_text))
+        conversation.reset_steps(user_info)
+        db.update_data(user_id, user_info)
+    elif action == "login":
+        try:
+            response = backend.search(user_info["idNumber"])
+            print(response, user_info["idNumber"])
             if response.status_code == 200:
+                # 成功後，清掉步驟並發送操作選項
+                conversation.reset_steps(user_info)
+                db.update_data(user_id, user_info)
 
-                flex = progress_bar("集點券", "目前集點進度", health_measurement, 15)
-                msg_list.append(
-                    FlexMessage(
-                        alt_text="hello", contents=FlexContainer.from_dict(flex)
-                    )
-                )
-
-                if health_measurement < 15:
-                    reply_text = f"集點成功，加油!!"
-                if health_measurement == 15:
-                    reply_text = f"集滿囉!!!可以拿給志工確認換禮物囉~"
-                if health_measurement > 15:
-                    reply_text = "有持續量血壓很棒喔~"
-                msg_list.append(TextMessage(text=reply_text))
-            else:
-                reply_text = "集點失敗！請稍後嘗試!"
-                msg_list.append(TextMessage(text=reply_text))
-        elif message == "所有集點":
-            msg_list.append(create_operation_options())
-            push_message = True
-        elif message == "登入":
-            user_info["steptype"] = "登入"
-            reply_text = "請輸入身分證字號"
-            msg_list.append(TextMessage(text=reply_text))
-    else:
-
-        if user_info["steptype"] == "連結LINEID":
-            idNumber = message
-            lineId = user_id
-
-            if check_id_number(idNumber):
+                db.ensure_current()
                 try:
-                    url = build_url("/linkLineID/")
-                    response = requests.post(
-                        url,
-                        json={"idNumber": idNumber, "lineId": lineId},
+                    response = call_once(
+                        backend.link_line_id, user_info["idNumber"], user_id
                     )
-                    data = response.json()
-                    response_message = data.get("detail")
-                    if response.status_code == 200:
-                        reply_text = "連結成功"
-                    elif response.status_code == 400 :
-                        reply_text = response_message
-                    else:
-                        reply_text = "重複連結或錯誤，請確認!"
+                    conversation.link_reply(user_info, response.status_code)
+                    db.update_data(user_id, user_info)
                 except Exception as e:
                     print(f"Error during request: {e}")
-                    reply_text = "請聯絡管理員"
 
-                msg_list.append(TextMessage(text=reply_text))
-                # 完成步驟後，重設步驟狀態（如果需要）
-                user_info["steptype"] = None
-                user_info["step"] = 0  # 重設步驟為0
-                user_info["errcount"] = 0
-                db.update_data(user_id, user_info)
+                msg_list.append(create_operation_options())
             else:
-                user_info["errcount"] += 1
-                db.update_data(user_id, user_info)
-                reply_text = (
-                    "身分證字號格式錯誤，請輸入有效的身分證字號（1個字母 + 9個數字）"
-                )
-                msg_list.append(TextMessage(text=reply_text))
-
-        elif user_info["steptype"] == "新會員":
-            if user_info["step"] == 1:
-                user_info["step"] = 2
-                user_info["name"] = message
-                db.update_data(user_id, user_info)
-                reply_text = "請輸入身分證字號"
-                msg_list.append(TextMessage(text=reply_text))
-            elif user_info["step"] == 2:
-                if check_id_number(message):
-                    user_info["idNumber"] = message
-                    user_info["step"] = 3
-                    db.update_data(user_id, user_info)
-                    reply_text = "請輸入電話號碼"
-                    msg_list.append(TextMessage(text=reply_text))
+                msg_list.append(TextMessage(text="請註冊!!"))
+        except db.ConflictError:
+            # 交給 dispatch_event 重新處理
+            raise
+        except:
+            msg_list.append(TextMessage(text=conversation.CONTACT_ADMIN_TEXT))
 
-                else:
-                    user_info["errcount"] += 1
-                    db.update_data(user_id, user_info)
-                    reply_text = "格式錯誤！請輸入 1 個英文字母和 9 個數字。"
-                    msg_list.append(TextMessage(text=reply_text))
-            elif user_info["step"] == 3:
-                user_info["tel"] = message
-                user_info["step"] = 4
-                db.update_data(user_id, user_info)
-                # Create confirmation template message
-                buttons_template = ButtonsTemplate(
-                    title="請確認您的資料",
-                    text=(
-                        f"您的姓名是 {user_info['name']}、\n"
-                        f"身份證字號是 {user_info['idNumber']}、\n"
-                        f"電話是 {user_info['tel']}。\n請問是否正確？"
-                    ),
-                    actions=[
-                        PostbackAction(label="是", data="correct"),
-                        PostbackAction(label="否", data="incorrect"),
-                    ],
-                )
-                template_message = TemplateMessage(
-                    alt_text="確認資料", template=buttons_template
-                )
-                msg_list.append(template_message)
-
-            elif user_info["step"] == 4:
-                if check_id_number(message):
-                    user_info["idNumber"] = message
-                    try:
-                        url = build_url("/search/")
-                        response = requests.get(
-                            url,
-                            json={"idNumber": user_info["idNumber"]},
-                        )
-                        print(response, user_info["idNumber"])
-                        if response.status_code == 200:
-                            # 成功後，清掉步驟並發送操作選項
-                            user_info["steptype"] = None
-                            user_info["step"] = 0  # 重設步驟為0
-                            user_info["errcount"] = 0
-                            db.update_data(user_id, user_info)
-                            print(user_id, user_info)
-                            
-                            idNumber = user_info['idNumber']
-                            lineId = user_id
-
-                            try:
-                                url = build_url("/linkLineID/")
-                                response = requests.post(
-                                    url,
-                                    json={"idNumber": idNumber, "lineId": lineId},
-                                )
-                                if response.status_code == 200:
-                                    reply_text = "連結成功"
-                                else:
-                                    reply_text = "重複連結或錯誤，請確認!"
-                            except Exception as e:
-                                print(f"Error during request: {e}")
-                                reply_text = "請聯絡管理員"
-
-                            msg_list.append(create_operation_options())
-                            push_message = True
-                        else:
-                            reply_text = "請註冊!!"
-                            msg_list.append(TextMessage(text=reply_text))
-
-                    except:
-                        reply_text = "請聯絡管理員"
-                        msg_list.append(TextMessage(text=reply_text))
-                else:
-                    user_info["errcount"] += 1
-                    db.update_data(user_id, user_info)
-                    reply_text = "登入步驟錯誤或身分證字號格式錯誤"
-                    msg_list.append(TextMessage(text=reply_text))
-            
-    return msg_list, push_message
+    return msg_list
 
 
 @handler.add(PostbackEvent)
 def handle_postback(event):
-    msg_list = []
+    user_info = db.get_or_create(
+        event.source.user_id, conversation.createUserInfo(event.source.user_id)
+    )
 
-    qdata = db.query_data(event.source.user_id)
-    if qdata is not None:
-        user_info = qdata
-    else:
-        print("No result found")
-        user_info = createUserInfo(event.source.user_id)
-        db.insert_data(event.source.user_id, user_info)
-
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        
-        tk = event.reply_token
-        data = event.postback.data
-
-        if data == "correct":
-            try:
-                url = build_url("/add_user/")
-                response = requests.post(
-                    url,
-                    json={
-                        "name": user_info["name"],
-                        "idNumber": user_info["idNumber"],
-                        "tel": user_info["tel"],
-                    },  # 傳遞的 JSON 資料
-                )
-                if response.status_code == 200:
-                    # Confirm registration completion
-                    user_info["register"] = True
-                    db.update_data(event.source.user_id, user_info)
-
-                    reply_text = "註冊完成！請輸入身分證字號登入"
-                    line_bot_api.reply_message_with_http_info(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=reply_text)],
-                        )
-                    )
-                else:
-                    reply_text = "註冊失敗！請稍後嘗試!"
-                    line_bot_api.reply_message_with_http_info(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=reply_text)],
-                        )
-                    )
-            except:
-                reply_text = "請聯絡管理員"
-                # Confirm registration completion
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_text)],
-                    )
-                )
-        elif data == "incorrect":
-            # Reset user information if incorrect
-            user_info = createUserInfo(event.source.user_id)
-            user_info["steptype"] = "新會員"
-            user_info["step"] = 1
-            db.update_data(event.source.user_id, user_info)
-
-            reply_text = "請重新輸入姓名"
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_text)],
-                )
-            )
-        elif data == "start":
-            buttons_template = ButtonsTemplate(
-                title="請問你要處理哪個項目？",
-                text="請點擊以下選項",
-                actions=[
-                    PostbackAction(label="生理監測", data="monitor"),
-                    PostbackAction(label="AI衛教", data="educate"),
-                    PostbackAction(label="運動", data="exercise"),
-                    PostbackAction(label="登出", data="logout"),
-                ],
-            )
+    # 這個事件要回覆的訊息都先放進 composer，處理完再一次送出
+    composer = message_composer.current()
 
-            template_message = TemplateMessage(
-                alt_text="請問你要進行什麼集點？", template=buttons_template
-            )
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token, messages=[template_message]
-                )
-            )
-        elif data == "logout":
-            user_info["steptype"] = None
-            user_info["step"] = 0
-            user_info["errcount"] = 0
-            db.update_data(event.source.user_id, user_info)
-            
-            try:
-                url = build_url("/logout/")
-                response = requests.delete(
-                    url,
-                    json={"lineId": user_info["user_id"]},
-                )
-                if response.status_code == 200:
-                    reply_text = "登出成功"
-                else:
-                    reply_text = "請重試"
-            except Exception as e:
-                    print(f"Error during request: {e}")
-                    reply_text = "請聯絡管理員"
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_text)],
-                )
-            )
-        elif data == "monitor":
-            url = build_url("/add/healthMeasurement")
-            response = requests.put(
-                url,
-                json={"lineId": user_info["user_id"]},  # 傳遞的 JSON 資料
-            )
-            
-            data = response.json()
-            health_measurement = data.get("healthMeasurement")
-            
-            if response.status_code == 200:
-                flex = progress_bar("量血壓次數", "目前集點進度", health_measurement, 15)
-                msg_list.append(
-                    FlexMessage(
-                        alt_text="hello", contents=FlexContainer.from_dict(flex)
-                    )
-                )
-
-                reply_text = "集點完成"
-                msg_list.append(TextMessage(text=reply_text))
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=msg_list,
-                    )
-                )
-                send_other_operation_options(line_bot_api, user_info["user_id"])
-            else:
-                reply_text = "集點失敗！請稍後嘗試!"
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_text)],
-                    )
-                )
-        elif data == "educate":
-            url = build_url("/add/healthEducation")
-            response = requests.put(
-                url,
-                json={"lineId": user_info["user_id"]},  # 傳遞的 JSON 資料
+    data = event.postback.data
+
+    if data == "correct":
+        db.ensure_current()
+        try:
+            response = call_once(
+                backend.add_user,
+                user_info["name"],
+                user_info["idNumber"],
+                user_info["tel"],
             )
-            
-            data = response.json()
-            health_education = data.get("healthEducation")
-            
             if response.status_code == 200:
-                
-                flex = progress_bar("AI衛教次數", "目前集點進度", health_education, 2)
-                msg_list.append(
-                    FlexMessage(
-                        alt_text="hello", contents=FlexContainer.from_dict(flex)
-                    )
-                )
-                
-                reply_text = "集點完成"
-                msg_list.append(TextMessage(text=reply_text))
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=msg_list,
-                    )
-                )
+                # Confirm registration completion
+                user_info["register"] = True
+                db.update_data(event.source.user_id, user_info)
+
+                reply_text = "註冊完成！請輸入身分證字號登入"
             else:
-                reply_text = "集點失敗！請稍後嘗試!"
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_text)],
-                    )
-                )
-            send_other_operation_options(line_bot_api, user_info["user_id"])
-        elif data == "exercise":
-            url = build_url("/add/exercise")
-            response = requests.put(
-                url,
-                json={"lineId": user_info["user_id"]},  # 傳遞的 JSON 資料
-            )
-            
-            data = response.json()
-            exercise = data.get("exercise")
-            
+                reply_text = "註冊失敗！請稍後嘗試!"
+        except:
+            reply_text = conversation.CONTACT_ADMIN_TEXT
+        composer.add(TextMessage(text=reply_text))
+    elif data == "incorrect":
+        # Reset user information if incorrect
+        user_info = conversation.restart_registration(event.source.user_id)
+        db.update_data(event.source.user_id, user_info)
+
+        reply_text = "請重新輸入姓名"
+        composer.add(TextMessage(text=reply_text))
+    elif data == "start":
+        composer.add(templates.get("start_menu"))
+    elif data == "logout":
+        conversation.logged_out(user_info)
+        db.update_data(event.source.user_id, user_info)
+
+        try:
+            response = backend.logout(user_info["user_id"])
             if response.status_code == 200:
-                flex = progress_bar("運動次數", "目前集點進度", exercise, 6)
-                msg_list.append(
-                    FlexMessage(
-                        alt_text="hello", contents=FlexContainer.from_dict(flex)
-                    )
-                )
-
-                reply_text = "集點完成"
-                msg_list.append(TextMessage(text=reply_text))
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=msg_list,
-                    )
-                )
+                reply_text = "登出成功"
             else:
-                reply_text = "集點失敗！請稍後嘗試!"
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_text)],
-                    )
-                )
-            send_other_operation_options(line_bot_api, user_info["user_id"])
+                reply_text = "請重試"
+        except Exception as e:
+                print(f"Error during request: {e}")
+                reply_text = conversation.CONTACT_ADMIN_TEXT
+        composer.add(TextMessage(text=reply_text))
+    elif data == "progress" and stamp_counters.enabled():
+        composer.add(*show_progress(user_info))
+        composer.add(templates.get("other_operation_options"))
+    elif data in conversation.POSTBACK_KINDS:
+        kind = conversation.POSTBACK_KINDS[data]
+        count, queued = add_stamp(kind, user_info, event.webhook_event_id)
+        # 其他項目選單併在同一次回覆內，不另外 push
+        composer.add(*conversation.postback_stamp_messages(kind, count, queued))
 
 
 # 加入好友
@@ -723,43 +412,22 @@ def handle_follow(event):
     app.logger.info("Got Follow event:" + event.source.user_id)
     msg_list = []
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-
-        try:
-            profile = line_bot_api.get_profile(event.source.user_id)
-            print(profile.display_name)
-            welcometitle = "您好！歡迎使用健康小幫手，您看起來還不是我們會員，請選擇新會員或其他以獲得服務。"
-            if profile.display_name:
-                welcometitle = profile.display_name + welcometitle
-
-            msg_list.append(TextMessage(text=welcometitle))
-
-            buttons_template = ButtonsTemplate(
-                title="服務選單",
-                text="請點擊以下選項",
-                actions=[
-                    MessageAction(label="新會員", text="新會員"),
-                    PostbackAction(label="其他", data="idontknow"),
-                ],
-            )
+    line_bot_api = line_client.get_messaging_api()
 
-            template_message = TemplateMessage(
-                alt_text="歡迎新朋友～", template=buttons_template
-            )
+    try:
+        profile = line_bot_api.get_profile(event.source.user_id)
+        print(profile.display_name)
+        welcometitle = "您好！歡迎使用健康小幫手，您看起來還不是我們會員，請選擇新會員或其他以獲得服務。"
+        if profile.display_name:
+            welcometitle = profile.display_name + welcometitle
 
-            msg_list.append(template_message)
+        msg_list.append(TextMessage(text=welcometitle))
+        msg_list.append(templates.get("service_menu"))
 
-        except LineBotApiError as e:
-            print(e.status_code)
+    except LineBotApiError as e:
+        print(e.status_code)
 
-        if len(msg_list) > 0:
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=msg_list,
-                )
-            )
+    message_composer.current().add(*msg_list)
 
 
 # 取消好友
@@ -767,6 +435,7 @@ def handle_follow(event):
 def handle_unfollow(event):
     # 看法規政策 有時候可能需要刪除使用者資料
     app.logger.info("Got Unfollow event:" + event.source.user_id)
+    stamp_counters.invalidate(event.source.user_id)
 
 
 # 其他訊息的回應
@@ -801,10 +470,14 @@ def load_health_info(config_name: str):
     fh.close()
 
 
-def main():
+# gunicorn 只會 import 這個模組而不會執行 main()，所以在載入時就起始資料庫
+# 沒有 --preload 時每個 worker 會各自 import 一次
+db.init_db()
+load_health_info("bot_health_info.json")
+templates.warm_up()
+
 
-    db.init_db()
-    load_health_info("bot_health_info.json")
+def main():
 
     host_ip = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", 5000))  # 默認使用 5000，但優先使用環境變數 PORT
@@ -3,8 +3,6 @@ from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (
     Configuration,
-    ApiClient,
-    MessagingApi,
     ReplyMessageRequest,
     MessageAction,
     TextMessage,
@@ -14,7 +12,6 @@ from linebot.v3.messaging import (
     ButtonsTemplate,
     PostbackAction,
     ImageMessage,
-    PushMessageRequest,
 )
 
 from linebot.v3.webhooks import (
@@ -34,6 +31,8 @@ import os
 import json
 import random
 import persistence as db
+import line_client
+import push_queue
 from flask_cors import CORS
 import qrcode
 
@@ -64,6 +63,7 @@ secret = os.getenv("SECRET")
 
 configuration = Configuration(access_token=access_token)
 handler = WebhookHandler(secret)
+line_client.init(configuration)
 
 
 BASE_URL = "https://test-5unu.onrender.com"
@@ -184,9 +184,7 @@ def send_operation_options(line_bot_api, user_id):
     template_message = TemplateMessage(
         alt_text="請問你要進行什麼操作？", template=buttons_template
     )
-    line_bot_api.push_message_with_http_info(
-        PushMessageRequest(to=user_id, messages=[template_message])
-    )
+    push_queue.push(user_id, template_message)
 
 
 # 主動推送訊息給使用者
@@ -204,9 +202,7 @@ def send_other_operation_options(line_bot_api, user_id):
     template_message = TemplateMessage(
         alt_text="請問你還需要處理其他項目嗎？", template=buttons_template
     )
-    line_bot_api.push_message_with_http_info(
-        PushMessageRequest(to=user_id, messages=[template_message])
-    )
+    push_queue.push(user_id, template_message)
 
 
 @app.route(webhook, methods=["POST"])
@@ -278,19 +274,16 @@ def handle_message(event):
                 event.source.user_id, event.message.text)
 
     if len(msg_list) > 0:
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            if push_message:
-                line_bot_api.push_message_with_http_info(
-                    PushMessageRequest(to=user_id, messages=msg_list)
-                )
-            else:
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=msg_list,
-                    )
+        if push_message:
+            push_queue.push(user_id, *msg_list)
+        else:
+            line_bot_api = line_client.get_messaging_api()
+            line_bot_api.reply_message_with_http_info(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=msg_list,
                 )
+            )
     return
 
 
@@ -508,217 +501,216 @@ def handle_postback(event):
         user_info = createUserInfo(event.source.user_id)
         db.insert_data(event.source.user_id, user_info)
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        
-        tk = event.reply_token
-        data = event.postback.data
-
-        if data == "correct":
-            try:
-                url = build_url("/add_user/")
-                response = requests.post(
-                    url,
-                    json={
-                        "name": user_info["name"],
-                        "idNumber": user_info["idNumber"],
-                        "tel": user_info["tel"],
-                    },  # 傳遞的 JSON 資料
-                )
-                if response.status_code == 200:
-                    # Confirm registration completion
-                    user_info["register"] = True
-                    db.update_data(event.source.user_id, user_info)
-
-                    reply_text = "註冊完成！請輸入身分證字號登入"
-                    line_bot_api.reply_message_with_http_info(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=reply_text)],
-                        )
-                    )
-                else:
-                    reply_text = "註冊失敗！請稍後嘗試!"
-                    line_bot_api.reply_message_with_http_info(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=reply_text)],
-                        )
-                    )
-            except:
-                reply_text = "請聯絡管理員"
+    line_bot_api = line_client.get_messaging_api()
+
+    tk = event.reply_token
+    data = event.postback.data
+
+    if data == "correct":
+        try:
+            url = build_url("/add_user/")
+            response = requests.post(
+                url,
+                json={
+                    "name": user_info["name"],
+                    "idNumber": user_info["idNumber"],
+                    "tel": user_info["tel"],
+                },  # 傳遞的 JSON 資料
+            )
+            if response.status_code == 200:
                 # Confirm registration completion
+                user_info["register"] = True
+                db.update_data(event.source.user_id, user_info)
+
+                reply_text = "註冊完成！請輸入身分證字號登入"
                 line_bot_api.reply_message_with_http_info(
                     ReplyMessageRequest(
                         reply_token=event.reply_token,
                         messages=[TextMessage(text=reply_text)],
                     )
                 )
-        elif data == "incorrect":
-            # Reset user information if incorrect
-            user_info = createUserInfo(event.source.user_id)
-            user_info["steptype"] = "新會員"
-            user_info["step"] = 1
-            db.update_data(event.source.user_id, user_info)
-
-            reply_text = "請重新輸入姓名"
+            else:
+                reply_text = "註冊失敗！請稍後嘗試!"
+                line_bot_api.reply_message_with_http_info(
+                    ReplyMessageRequest(
+                        reply_token=event.reply_token,
+                        messages=[TextMessage(text=reply_text)],
+                    )
+                )
+        except:
+            reply_text = "請聯絡管理員"
+            # Confirm registration completion
             line_bot_api.reply_message_with_http_info(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
                     messages=[TextMessage(text=reply_text)],
                 )
             )
-        elif data == "start":
-            buttons_template = ButtonsTemplate(
-                title="請問你要處理哪個項目？",
-                text="請點擊以下選項",
-                actions=[
-                    PostbackAction(label="生理監測", data="monitor"),
-                    PostbackAction(label="AI衛教", data="educate"),
-                    PostbackAction(label="運動", data="exercise"),
-                    PostbackAction(label="登出", data="logout"),
-                ],
+    elif data == "incorrect":
+        # Reset user information if incorrect
+        user_info = createUserInfo(event.source.user_id)
+        user_info["steptype"] = "新會員"
+        user_info["step"] = 1
+        db.update_data(event.source.user_id, user_info)
+
+        reply_text = "請重新輸入姓名"
+        line_bot_api.reply_message_with_http_info(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=reply_text)],
+            )
+        )
+    elif data == "start":
+        buttons_template = ButtonsTemplate(
+            title="請問你要處理哪個項目？",
+            text="請點擊以下選項",
+            actions=[
+                PostbackAction(label="生理監測", data="monitor"),
+                PostbackAction(label="AI衛教", data="educate"),
+                PostbackAction(label="運動", data="exercise"),
+                PostbackAction(label="登出", data="logout"),
+            ],
+        )
+
+        template_message = TemplateMessage(
+            alt_text="請問你要進行什麼集點？", template=buttons_template
+        )
+        line_bot_api.reply_message_with_http_info(
+            ReplyMessageRequest(
+                reply_token=event.reply_token, messages=[template_message]
+            )
+        )
+    elif data == "logout":
+        user_info["steptype"] = None
+        user_info["step"] = 0
+        user_info["errcount"] = 0
+        db.update_data(event.source.user_id, user_info)
+
+        try:
+            url = build_url("/logout/")
+            response = requests.delete(
+                url,
+                json={"lineId": user_info["user_id"]},
+            )
+            if response.status_code == 200:
+                reply_text = "登出成功"
+            else:
+                reply_text = "請重試"
+        except Exception as e:
+                print(f"Error during request: {e}")
+                reply_text = "請聯絡管理員"
+        line_bot_api.reply_message_with_http_info(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=reply_text)],
             )
+        )
+    elif data == "monitor":
+        url = build_url("/add/healthMeasurement")
+        response = requests.put(
+            url,
+            json={"lineId": user_info["user_id"]},  # 傳遞的 JSON 資料
+        )
+
+        data = response.json()
+        health_measurement = data.get("healthMeasurement")
 
-            template_message = TemplateMessage(
-                alt_text="請問你要進行什麼集點？", template=buttons_template
+        if response.status_code == 200:
+            flex = progress_bar("量血壓次數", "目前集點進度", health_measurement, 15)
+            msg_list.append(
+                FlexMessage(
+                    alt_text="hello", contents=FlexContainer.from_dict(flex)
+                )
             )
+
+            reply_text = "集點完成"
+            msg_list.append(TextMessage(text=reply_text))
             line_bot_api.reply_message_with_http_info(
                 ReplyMessageRequest(
-                    reply_token=event.reply_token, messages=[template_message]
+                    reply_token=event.reply_token,
+                    messages=msg_list,
                 )
             )
-        elif data == "logout":
-            user_info["steptype"] = None
-            user_info["step"] = 0
-            user_info["errcount"] = 0
-            db.update_data(event.source.user_id, user_info)
-            
-            try:
-                url = build_url("/logout/")
-                response = requests.delete(
-                    url,
-                    json={"lineId": user_info["user_id"]},
-                )
-                if response.status_code == 200:
-                    reply_text = "登出成功"
-                else:
-                    reply_text = "請重試"
-            except Exception as e:
-                    print(f"Error during request: {e}")
-                    reply_text = "請聯絡管理員"
+            send_other_operation_options(line_bot_api, user_info["user_id"])
+        else:
+            reply_text = "集點失敗！請稍後嘗試!"
             line_bot_api.reply_message_with_http_info(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
                     messages=[TextMessage(text=reply_text)],
                 )
             )
-        elif data == "monitor":
-            url = build_url("/add/healthMeasurement")
-            response = requests.put(
-                url,
-                json={"lineId": user_info["user_id"]},  # 傳遞的 JSON 資料
-            )
-            
-            data = response.json()
-            health_measurement = data.get("healthMeasurement")
-            
-            if response.status_code == 200:
-                flex = progress_bar("量血壓次數", "目前集點進度", health_measurement, 15)
-                msg_list.append(
-                    FlexMessage(
-                        alt_text="hello", contents=FlexContainer.from_dict(flex)
-                    )
-                )
+    elif data == "educate":
+        url = build_url("/add/healthEducation")
+        response = requests.put(
+            url,
+            json={"lineId": user_info["user_id"]},  # 傳遞的 JSON 資料
+        )
 
-                reply_text = "集點完成"
-                msg_list.append(TextMessage(text=reply_text))
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=msg_list,
-                    )
-                )
-                send_other_operation_options(line_bot_api, user_info["user_id"])
-            else:
-                reply_text = "集點失敗！請稍後嘗試!"
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_text)],
-                    )
+        data = response.json()
+        health_education = data.get("healthEducation")
+
+        if response.status_code == 200:
+
+            flex = progress_bar("AI衛教次數", "目前集點進度", health_education, 2)
+            msg_list.append(
+                FlexMessage(
+                    alt_text="hello", contents=FlexContainer.from_dict(flex)
                 )
-        elif data == "educate":
-            url = build_url("/add/healthEducation")
-            response = requests.put(
-                url,
-                json={"lineId": user_info["user_id"]},  # 傳遞的 JSON 資料
             )
-            
-            data = response.json()
-            health_education = data.get("healthEducation")
-            
-            if response.status_code == 200:
-                
-                flex = progress_bar("AI衛教次數", "目前集點進度", health_education, 2)
-                msg_list.append(
-                    FlexMessage(
-                        alt_text="hello", contents=FlexContainer.from_dict(flex)
-                    )
-                )
-                
-                reply_text = "集點完成"
-                msg_list.append(TextMessage(text=reply_text))
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=msg_list,
-                    )
+
+            reply_text = "集點完成"
+            msg_list.append(TextMessage(text=reply_text))
+            line_bot_api.reply_message_with_http_info(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=msg_list,
                 )
-            else:
-                reply_text = "集點失敗！請稍後嘗試!"
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_text)],
-                    )
+            )
+        else:
+            reply_text = "集點失敗！請稍後嘗試!"
+            line_bot_api.reply_message_with_http_info(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text=reply_text)],
                 )
-            send_other_operation_options(line_bot_api, user_info["user_id"])
-        elif data == "exercise":
-            url = build_url("/add/exercise")
-            response = requests.put(
-                url,
-                json={"lineId": user_info["user_id"]},  # 傳遞的 JSON 資料
             )
-            
-            data = response.json()
-            exercise = data.get("exercise")
-            
-            if response.status_code == 200:
-                flex = progress_bar("運動次數", "目前集點進度", exercise, 6)
-                msg_list.append(
-                    FlexMessage(
-                        alt_text="hello", contents=FlexContainer.from_dict(flex)
-                    )
+        send_other_operation_options(line_bot_api, user_info["user_id"])
+    elif data == "exercise":
+        url = build_url("/add/exercise")
+        response = requests.put(
+            url,
+            json={"lineId": user_info["user_id"]},  # 傳遞的 JSON 資料
+        )
+
+        data = response.json()
+        exercise = data.get("exercise")
+
+        if response.status_code == 200:
+            flex = progress_bar("運動次數", "目前集點進度", exercise, 6)
+            msg_list.append(
+                FlexMessage(
+                    alt_text="hello", contents=FlexContainer.from_dict(flex)
                 )
+            )
 
-                reply_text = "集點完成"
-                msg_list.append(TextMessage(text=reply_text))
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=msg_list,
-                    )
+            reply_text = "集點完成"
+            msg_list.append(TextMessage(text=reply_text))
+            line_bot_api.reply_message_with_http_info(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=msg_list,
                 )
-            else:
-                reply_text = "集點失敗！請稍後嘗試!"
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_text)],
-                    )
+            )
+        else:
+            reply_text = "集點失敗！請稍後嘗試!"
+            line_bot_api.reply_message_with_http_info(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text=reply_text)],
                 )
-            send_other_operation_options(line_bot_api, user_info["user_id"])
+            )
+        send_other_operation_options(line_bot_api, user_info["user_id"])
 
 
 # 加入好友
@@ -727,43 +719,42 @@ def handle_follow(event):
     app.logger.info("Got Follow event:" + event.source.user_id)
     msg_list = []
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
+    line_bot_api = line_client.get_messaging_api()
 
-        try:
-            profile = line_bot_api.get_profile(event.source.user_id)
-            print(profile.display_name)
-            welcometitle = "您好！歡迎使用健康小幫手，您看起來還不是我們會員，請選擇新會員或其他以獲得服務。"
-            if profile.display_name:
-                welcometitle = profile.display_name + welcometitle
-
-            msg_list.append(TextMessage(text=welcometitle))
-
-            buttons_template = ButtonsTemplate(
-                title="服務選單",
-                text="請點擊以下選項",
-                actions=[
-                    MessageAction(label="新會員", text="新會員"),
-                    PostbackAction(label="其他", data="idontknow"),
-                ],
-            )
+    try:
+        profile = line_bot_api.get_profile(event.source.user_id)
+        print(profile.display_name)
+        welcometitle = "您好！歡迎使用健康小幫手，您看起來還不是我們會員，請選擇新會員或其他以獲得服務。"
+        if profile.display_name:
+            welcometitle = profile.display_name + welcometitle
+
+        msg_list.append(TextMessage(text=welcometitle))
+
+        buttons_template = ButtonsTemplate(
+            title="服務選單",
+            text="請點擊以下選項",
+            actions=[
+                MessageAction(label="新會員", text="新會員"),
+                PostbackAction(label="其他", data="idontknow"),
+            ],
+        )
 
-            template_message = TemplateMessage(
-                alt_text="歡迎新朋友～", template=buttons_template
-            )
+        template_message = TemplateMessage(
+            alt_text="歡迎新朋友～", template=buttons_template
+        )
 
-            msg_list.append(template_message)
+        msg_list.append(template_message)
 
-        except LineBotApiError as e:
-            print(e.status_code)
+    except LineBotApiError as e:
+        print(e.status_code)
 
-        if len(msg_list) > 0:
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=msg_list,
-                )
+    if len(msg_list) > 0:
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=msg_list,
             )
+        )
 
 
 # 取消好友
@@ -838,19 +829,13 @@ def handle_qrcode_request(event):
         image_url = f"{BASE_URL}/{QR_CODE_DIR}{generated_number}.png"
 
         # 回傳 QR Code 給使用者
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.push_message_with_http_info(
-                PushMessageRequest(
-                    to=user_id,
-                    messages=[
-                        ImageMessage(
-                            original_content_url=image_url,
-                            preview_image_url=image_url,
-                        )
-                    ],
-                )
-            )
+        push_queue.push(
+            user_id,
+            ImageMessage(
+                original_content_url=image_url,
+                preview_image_url=image_url,
+            ),
+        )
         return
 
     # 如果使用者傳送的是數字，檢查是否與生成的隨機數字相符
@@ -861,14 +846,13 @@ def handle_qrcode_request(event):
             handle_message(event)  # 使用現有的處理邏輯
         else:
             # 數字不匹配，回應錯誤訊息
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="無效的 QR Code 數字，請重新掃描並輸入。")],
-                    )
+            line_bot_api = line_client.get_messaging_api()
+            line_bot_api.reply_message_with_http_info(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text="無效的 QR Code 數字，請重新掃描並輸入。")],
                 )
+            )
         return
 
     # 處理其他訊息
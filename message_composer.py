@@ -0,0 +1,153 @@
+"""
+回覆訊息的組合模組
+同一個事件要送給使用者的訊息先收集起來，事件處理完再用一次 reply 送出 (最多 5 則)
+超過 5 則或 reply token 已經用過 / 過期時才改用 push (交給 push_queue 送出)，節省 API 呼叫次數和每月的 push 額度
+
+reply token 只在收到事件後一段時間內有效，事件在佇列等太久或後端太慢時會過期
+送出前先用事件的時間戳記檢查，已經超過期限就不浪費一次 reply 呼叫，直接改用 push
+reply 回 400 且錯誤內容是 reply token 無效時才改用 push，其他 400 (例如訊息格式錯誤) push 也一樣會失敗，直接丟出
+
+環境變數:
+    REPLY_TOKEN_TTL 事件發生後多少秒內還使用 reply，預設 50 (LINE 的期限大約 1 分鐘)
+
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from linebot.v3.messaging import ApiException, ReplyMessageRequest
+
+import line_client
+import push_queue
+
+logger = logging.getLogger(__name__)
+
+# LINE 一次 reply / push 最多 5 則訊息
+MAX_MESSAGES = 5
+
+# reply token 已經用過或過期時，LINE 回 400 的錯誤訊息
+INVALID_REPLY_TOKEN = "Invalid reply token"
+
+# 定義全域變數
+_local = threading.local()
+_lock = threading.Lock()
+_stats = {
+    "replies": 0,
+    "pushes": 0,
+    "push_fallbacks": 0,
+    "expired_tokens": 0,
+    "invalid_tokens": 0,
+}
+
+
+def _count(name: str, n: int = 1):
+    with _lock:
+        _stats[name] += n
+
+
+def _token_ttl() -> float:
+    return float(os.getenv("REPLY_TOKEN_TTL", "50"))
+
+
+def _invalid_token(e: ApiException) -> bool:
+    body = e.body
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", "replace")
+    return INVALID_REPLY_TOKEN in (body or "")
+
+
+class MessageComposer:
+    # timestamp 是事件發生的時間 (毫秒，webhook 事件的 timestamp)，None 表示不檢查期限
+    def __init__(self, reply_token: str, user_id: str, timestamp: int = None):
+        self.reply_token = reply_token
+        self.user_id = user_id
+        self.deadline = None
+        if timestamp is not None:
+            self.deadline = timestamp / 1000 + _token_ttl()
+        self.messages = []
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.time() > self.deadline
+
+    def add(self, *messages):
+        self.messages.extend(messages)
+
+    # 取出要送的訊息，reply token 已經過期就不用 reply
+    def _take(self):
+        messages, self.messages = self.messages, []
+        if messages and self.reply_token and self.expired() and self.user_id:
+            logger.warning("Reply token expired, fall back to push")
+            self.reply_token = None
+            _count("expired_tokens")
+            _count("push_fallbacks")
+        reply_token, self.reply_token = self.reply_token, None
+        return reply_token, messages
+
+    # reply 失敗時決定要不要改用 push，只有 reply token 無效 (已經用過或過期) 時才改用 push
+    def _reply_failed(self, e: ApiException):
+        if e.status != 400 or not self.user_id or not _invalid_token(e):
+            logger.error(f"Reply failed: {e.status} {e.body}")
+            raise e
+        logger.warning(f"Reply failed, fall back to push: {e.reason}")
+        _count("invalid_tokens")
+        _count("push_fallbacks")
+
+    def _push(self, messages):
+        if messages:
+            push_queue.push(self.user_id, *messages)
+            _count("pushes")
+
+    # 送出收集到的訊息，前 5 則用 reply，其餘用 push
+    def send(self):
+        reply_token, messages = self._take()
+        if reply_token and messages:
+            batch, rest = messages[:MAX_MESSAGES], messages[MAX_MESSAGES:]
+            try:
+                line_client.get_messaging_api().reply_message_with_http_info(
+                    ReplyMessageRequest(reply_token=reply_token, messages=batch)
+                )
+                _count("replies")
+                messages = rest
+            except ApiException as e:
+                self._reply_failed(e)
+        self._push(messages)
+
+    # 同 send()，reply 改用 AsyncMessagingApi (async_app 使用)
+    async def send_async(self, line_bot_api):
+        reply_token, messages = self._take()
+        if reply_token and messages:
+            batch, rest = messages[:MAX_MESSAGES], messages[MAX_MESSAGES:]
+            try:
+                await line_bot_api.reply_message_with_http_info(
+                    ReplyMessageRequest(reply_token=reply_token, messages=batch)
+                )
+                _count("replies")
+                messages = rest
+            except ApiException as e:
+                self._reply_failed(e)
+        self._push(messages)
+
+
+# 目前執行緒正在處理的事件的 composer，沒有的話回傳 None
+def current():
+    return getattr(_local, "composer", None)
+
+
+# 一個事件的處理範圍，範圍內 add 的訊息在離開時一起送出
+@contextmanager
+def compose(reply_token: str, user_id: str, timestamp: int = None):
+    previous = current()
+    composer = MessageComposer(reply_token, user_id, timestamp)
+    _local.composer = composer
+    try:
+        yield composer
+    finally:
+        _local.composer = previous
+
+
+def stats() -> dict:
+    with _lock:
+        return dict(_stats)
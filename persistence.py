@@ -4,66 +4,639 @@
 存到記憶體的資料會在程式結束後消失
 
 環境變數沒有DB的設定時，會預設將資料存到記憶體中
+記憶體模式有筆數上限，太久沒有互動的使用者會被背景執行緒清掉
+    MEMORY_MAX_USERS     最多保留幾位使用者，超過時移除最久沒互動的，設成 0 表示不限制
+    MEMORY_IDLE_TTL      多久沒互動就移除 (秒)，預設 86400
+    MEMORY_SWEEP_INTERVAL 背景清理的間隔秒數，預設 60
+
+設定 DB_BACKEND=sqlite 時改用本機的 SQLite 檔案 (WAL 模式)，重新啟動後資料還在
+    SQLITE_PATH          資料庫檔案路徑，預設 sessions.db
+    SQLITE_BATCH_SIZE    一次 commit 最多合併幾筆寫入，預設 64
+
+設定 DB_BACKEND=shared 時，SQLite 檔案放在共享記憶體 (/dev/shm)，同一台主機的所有 worker 看到同一份資料
+沒有設定 DB_BACKEND、沒有開 MongoDB 且 WEB_CONCURRENCY 大於 1 時會自動使用 shared
+    SHARED_STORE_PATH    自訂檔案路徑，預設 /dev/shm/linebot-sessions.db
+
+在 unit_of_work() 範圍內對同一個使用者的多次 update_data 會先暫存，
+離開範圍時只把有變動的欄位寫入一次，沒有變動就不寫
+
+每份使用者資料都有 version 欄位，update_data 只有在資料庫內的 version 跟讀取時相同才會寫入
+否則丟出 ConflictError，呼叫端重新讀取後再處理一次 (樂觀鎖，不需要分散式鎖)
+事件處理中要呼叫不能重複的後端 API (集點、註冊) 時，先呼叫 ensure_current() 確認資料沒被改過，
+呼叫之後用 mark_irreversible() 標記，之後的寫入遇到衝突時改成合併最新的資料，不再要求重新處理
+
+有連到資料庫時，查詢結果會先放在每個 worker 自己的快取內 (LRU + TTL)
+快取只屬於這個 worker，其他 worker 更新資料時不會失效，可能讀到舊的 step / steptype
+unit_of_work 內讀到快取的資料時: 有寫入的話由 version 檢查擋下舊資料；沒有寫入的話，
+結束時再向資料庫確認一次 version，不一樣就丟出 ConflictError，讓呼叫端用最新的資料重新處理
+    CACHE_SIZE          快取筆數上限，預設 1024，設成 0 表示不使用快取
+    CACHE_TTL           快取有效秒數，預設 300
+更新資料時同時更新這個 worker 的快取 (write-through)，下一個事件不用再查資料庫
+
+MongoDB 啟動時會建立 user_id 的唯一索引，有設定 SESSION_TTL 時另外建立 last_active 的 TTL 索引
+TTL 會刪除整份使用者資料，包含註冊 (register)、連結 (linked) 和點數，久沒互動的會員也會被刪掉
+    SESSION_TTL         多久沒有活動就自動刪除資料 (秒)，預設 0 (不刪除，並移除之前建立的 TTL 索引)
 
 """
 
 import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from collections import OrderedDict
+from contextlib import contextmanager
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from sqlite_store import SqliteStore
 
 # 起始或讀取環境變數
 load_dotenv()
 
+
+# 資料已經被別人更新過，version 對不上
+class ConflictError(Exception):
+    pass
+
+
+# 有筆數上限 (LRU) 和有效時間 (TTL) 的快取
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    # 讀取時是否重新計算有效時間 (閒置多久才過期)
+    sliding = False
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            value, expires = item
+            now = time.monotonic()
+            if expires < now:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            if self.sliding:
+                self._data[key] = (value, now + self.ttl)
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._set(key, value)
+
+    # 呼叫前要先取得 self._lock
+    def _set(self, key, value):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while 0 < self.maxsize < len(self._data):
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    # 只有快取內已經有這筆資料時才合併更新
+    # 有指定 version 時，快取內的 version 不同表示快取的是其他版本，合併會混到舊的欄位，直接移除
+    def merge(self, key, value: dict, version=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return
+            if version is not None and (item[0].get("version") or 0) != version:
+                del self._data[key]
+                return
+            item[0].update(value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+# 記憶體模式的資料存放區，超過筆數上限或閒置太久的使用者會被移除
+# 存進去跟讀出來的都是複本，跟 SqliteStore 一樣，呼叫端要 update_data 才會寫入
+class MemoryStore(TTLCache):
+    sliding = True
+
+    def __init__(self, maxsize: int, ttl: float, sweep_interval: float):
+        super().__init__(maxsize, ttl)
+        self.sweep_interval = sweep_interval
+        self._sweeper_pid = None
+
+    def get(self, key):
+        value = super().get(key)
+        return dict(value) if value is not None else None
+
+    def put(self, key, value):
+        self._start_sweeper()
+        with self._lock:
+            self._set(key, dict(value))
+
+    def setdefault(self, key, value):
+        self._start_sweeper()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] >= time.monotonic():
+                self._data[key] = (item[0], time.monotonic() + self.ttl)
+                self._data.move_to_end(key)
+                return dict(item[0])
+            self._set(key, dict(value))
+            return dict(value)
+
+    # version 跟目前存的一樣才寫入，資料已經不在 (被清掉) 時直接寫入
+    def compare_and_set(self, key, version: int, value) -> bool:
+        self._start_sweeper()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] >= time.monotonic():
+                if item[0].get("version", 0) != version:
+                    return False
+            self._set(key, dict(value))
+            return True
+
+    # 移除已經過期的資料，資料依最後存取時間排序，過期的都在最前面
+    def sweep(self) -> int:
+        removed = 0
+        with self._lock:
+            now = time.monotonic()
+            while self._data:
+                key, (value, expires) = next(iter(self._data.items()))
+                if expires >= now:
+                    break
+                del self._data[key]
+                removed += 1
+            self.expirations += removed
+        return removed
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            self.sweep()
+
+    def stats(self) -> dict:
+        return dict(super().stats(), backend="memory")
+
+    # 依 key 排序逐批取出 (key, 資料)，從 after 之後開始，不會延長資料的有效時間
+    def scan(self, after=None, batch_size: int = 500):
+        with self._lock:
+            keys = sorted(k for k in self._data if after is None or k > after)
+        for i in range(0, len(keys), batch_size):
+            with self._lock:
+                items = [(k, self._data.get(k)) for k in keys[i : i + batch_size]]
+            now = time.monotonic()
+            for key, item in items:
+                if item is not None and item[1] >= now:
+                    yield key, dict(item[0])
+
+    # 記憶體模式只有單一行程，event_dedup 本身的記錄就夠了
+    def mark_event(self, event_id: str, window: float) -> bool:
+        return True
+
+    # gunicorn fork 之後子行程要自己啟動清理執行緒
+    def _start_sweeper(self):
+        if self._sweeper_pid == os.getpid() or self.sweep_interval <= 0:
+            return
+        with self._lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+        threading.Thread(
+            target=self._sweep_loop, name="memory-store-sweeper", daemon=True
+        ).start()
+
+
+# 對話流程需要的欄位，查詢時預設只取這些，使用者資料新增欄位時要一起加進來
+SESSION_FIELDS = (
+    "user_id",
+    "name",
+    "idNumber",
+    "tel",
+    "steptype",
+    "step",
+    "errcount",
+    "register",
+    # 透過 連結LINE集點 / 登入 連結成功的會員 (不一定是透過 bot 註冊)
+    "linked",
+    "version",
+    # 上次的集點數，後端暫時無法服務時用來算暫存的點數
+    "healthMeasurement_count",
+    "healthEducation_count",
+    "exercise_count",
+)
+
 # 定義全域變數
 collection = None
-user_map = {}
+# 已處理過的 webhook 事件 id，跟 collection 放在同一個資料庫
+event_collection = None
+# 沒有連 MongoDB 時的資料存放區，init_db 可能換成 SqliteStore
+user_map = MemoryStore(
+    int(os.getenv("MEMORY_MAX_USERS", "10000")),
+    float(os.getenv("MEMORY_IDLE_TTL", "86400")),
+    float(os.getenv("MEMORY_SWEEP_INTERVAL", "60")),
+)
+cache = TTLCache(
+    int(os.getenv("CACHE_SIZE", "1024")), float(os.getenv("CACHE_TTL", "300"))
+)
+
+# 每個執行緒目前的 unit of work
+_local = threading.local()
+
+
+def _projection(fields):
+    if fields is None:
+        return None
+    projection = {field: 1 for field in fields}
+    projection["_id"] = 0
+    return projection
+
+
+def _session_view(data: dict) -> dict:
+    return {k: data[k] for k in SESSION_FIELDS if k in data}
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _current_work(userID: str):
+    work = getattr(_local, "work", None)
+    if work is not None and work["user_id"] == userID:
+        return work
+    return None
+
+
+# 一個事件的處理範圍，範圍內的 update_data 合併成離開時的一次寫入
+# 寫入時 version 以範圍內第一次讀到的為準，被別人改過會丟出 ConflictError
+@contextmanager
+def unit_of_work(userID: str):
+    previous = getattr(_local, "work", None)
+    work = {"user_id": userID, "snapshot": None, "pending": None}
+    _local.work = work
+    try:
+        yield work
+    finally:
+        _local.work = previous
+        _flush(work)
+    _revalidate_cached(work)
+
+
+# 從快取讀到、之後又沒有寫入 (寫入時會檢查 version) 的資料，確認還是最新的
+def _revalidate_cached(work):
+    if not work.get("cached") or work.get("irreversible") or work["snapshot"] is None:
+        return
+    work["cached"] = False
+    revalidate(work["user_id"], work["snapshot"].get("version"))
+
+
+def _flush(work):
+    pending = work["pending"]
+    if pending is None:
+        return
+    snapshot = work["snapshot"]
+    version = (snapshot or pending).get("version")
+    changed = {
+        k: v
+        for k, v in pending.items()
+        if k != "version" and (snapshot is None or snapshot.get(k) != v)
+    }
+    work["pending"] = None
+    if changed:
+        try:
+            version = _write(work["user_id"], pending, changed, version)
+        except ConflictError:
+            if not work.get("irreversible"):
+                raise
+            pending, version = _merge(work["user_id"], changed)
+        # 寫入成功表示讀到的 version 是最新的，不用再確認
+        work["cached"] = False
+    work["snapshot"] = dict(pending, version=version)
+
+
+# 已經呼叫過不能重複的後端 API，重新處理會重複呼叫，改成把這次變動的欄位合併到最新的資料
+def _merge(userID: str, changed: dict, attempts: int = 10):
+    for _ in range(attempts):
+        latest = _query(userID, None) or {}
+        merged = dict(latest, **changed)
+        merged.pop("_id", None)
+        try:
+            return merged, _write(userID, merged, changed, latest.get("version") or 0)
+        except ConflictError:
+            continue
+    raise ConflictError(f"user {userID} kept changing while merging")
+
+
+# 資料庫內目前的 version，不經過快取，資料不存在時回傳 None
+def current_version(userID: str):
+    if collection != None:
+        result = collection.find_one({"user_id": userID}, {"version": 1, "_id": 0})
+    else:
+        result = user_map.get(userID)
+    if result is None:
+        return None
+    return result.get("version") or 0
+
+
+# version 不是資料庫內最新的就讓快取失效並丟出 ConflictError
+def revalidate(userID: str, version):
+    latest = current_version(userID)
+    if latest is not None and latest != (version or 0):
+        cache.invalidate(userID)
+        raise ConflictError(f"user {userID} was modified concurrently")
+
+
+# 呼叫不能重複的後端 API 之前呼叫: 先寫入暫存的更新，再確認讀到的資料還是最新的
+# 資料被別人改過就丟出 ConflictError，這時還沒呼叫後端，重新處理事件不會重複呼叫
+def ensure_current():
+    work = getattr(_local, "work", None)
+    if work is None:
+        return
+    _flush(work)
+    if work["snapshot"] is None or work.get("irreversible"):
+        return
+    work["cached"] = False
+    revalidate(work["user_id"], work["snapshot"].get("version"))
+
+
+# 標記這個 unit of work 已經呼叫過不能重複的後端 API
+def mark_irreversible():
+    work = getattr(_local, "work", None)
+    if work is not None:
+        work["irreversible"] = True
+
+
+# 把讀取時的內容 (snapshot) 跟修改後的內容 (data) 比較，只寫入有變動的欄位，回傳寫入後的版本
+# 效果跟 unit_of_work 結束時一樣，給不在同一個執行緒內處理完事件的呼叫端 (async_persistence) 使用
+def save_changes(
+    userID: str, snapshot: dict, data: dict, irreversible: bool = False
+) -> int:
+    work = {
+        "user_id": userID,
+        "snapshot": snapshot,
+        "pending": dict(data),
+        "irreversible": irreversible,
+    }
+    _flush(work)
+    return work["snapshot"]["version"]
 
 
 # 插入資料
 def insert_data(userID: str, data: any):
     global collection
+    work = _current_work(userID)
+    data.setdefault("version", 0)
+    if work is not None:
+        work["snapshot"] = dict(data)
+        work["pending"] = None
     if collection != None:
-        collection.insert_one(data)
+        collection.insert_one(dict(data, last_active=_now()))
+        cache.put(userID, _session_view(data))
     else:
-        user_map[userID] = data
+        user_map.put(userID, data)
 
 
-# 查詢資料
-def query_data(userID: str):
+# 查詢資料，fields 指定要取回的欄位，None 表示整份文件
+# 記憶體模式沒有傳輸成本，會直接回傳整份資料
+def query_data(userID: str, fields=SESSION_FIELDS):
     global collection
+    work = _current_work(userID)
+    if work is not None and work["pending"] is not None:
+        return dict(work["pending"])
+    result = _query(userID, fields)
+    if work is not None and result is not None and work["snapshot"] is None:
+        work["snapshot"] = dict(result)
+    return result
+
+
+def _query(userID: str, fields):
     if collection != None:
-        result = collection.find_one({"user_id": userID})
+        # 快取內放的是 SESSION_FIELDS 的內容，其他欄位組合直接查資料庫
+        use_cache = fields == SESSION_FIELDS
+        if use_cache:
+            cached = cache.get(userID)
+            if cached is not None:
+                _mark_cached(userID)
+                # 回傳複本，呼叫端修改內容不會影響快取
+                return dict(cached)
+        result = collection.find_one({"user_id": userID}, _projection(fields))
+        if result is not None and use_cache:
+            cache.put(userID, dict(result))
         return result
     else:
-        if userID in user_map:
-            return user_map[userID]
+        return user_map.get(userID)
 
-    return None
+
+# 記下 unit of work 第一次讀到的資料來自快取，結束時要確認是不是最新的
+def _mark_cached(userID: str):
+    work = _current_work(userID)
+    if work is not None and work["snapshot"] is None:
+        work["cached"] = True
+
+
+# 跟 get_or_create 一樣，另外回傳讀到的資料是不是來自這個 worker 的快取 (可能是舊的)
+# 給不在 unit_of_work 內處理事件的呼叫端 (async_persistence) 使用
+def get_or_create_cached(userID: str, defaults: dict, fields=SESSION_FIELDS):
+    previous = getattr(_local, "work", None)
+    work = {"user_id": userID, "snapshot": None, "pending": None}
+    _local.work = work
+    try:
+        result = get_or_create(userID, defaults, fields)
+    finally:
+        _local.work = previous
+    return result, bool(work.get("cached"))
 
 
-# 更新文件
+# 查詢資料，不存在就用 defaults 建立，一次完成不會重複建立
+def get_or_create(userID: str, defaults: dict, fields=SESSION_FIELDS):
+    global collection
+    work = _current_work(userID)
+    if work is not None and work["pending"] is not None:
+        return dict(work["pending"])
+    defaults = dict(defaults)
+    defaults.setdefault("version", 0)
+    if collection != None:
+        use_cache = fields == SESSION_FIELDS
+        cached = cache.get(userID) if use_cache else None
+        if cached is not None:
+            _mark_cached(userID)
+            result = dict(cached)
+        else:
+            # user_id 已經在查詢條件內，upsert 時會自動寫入
+            insert_fields = {
+                k: v for k, v in defaults.items() if k not in ("user_id", "last_active")
+            }
+            update = {"$set": {"last_active": _now()}}
+            if insert_fields:
+                update["$setOnInsert"] = insert_fields
+            result = collection.find_one_and_update(
+                {"user_id": userID},
+                update,
+                projection=_projection(fields),
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+            if use_cache:
+                cache.put(userID, dict(result))
+    else:
+        result = user_map.setdefault(userID, defaults)
+    if work is not None and work["snapshot"] is None:
+        work["snapshot"] = dict(result)
+    return result
+
+
+# 更新文件，data 內的 version 必須跟資料庫內的一樣，否則丟出 ConflictError
 def update_data(userID: str, data):
+    work = _current_work(userID)
+    if work is not None:
+        # 先記下這個時間點的內容，等 unit of work 結束再寫入
+        work["pending"] = dict(data)
+        return
+    data["version"] = _write(userID, data, data, data.get("version"))
+
+
+# data 是完整的資料，changed 是要寫入資料庫的欄位
+# version 是讀取時的版本，None 表示不檢查，回傳寫入後的版本
+def _write(userID: str, data, changed, version):
     global collection
+    changed = {k: v for k, v in changed.items() if k != "version"}
     if collection != None:
-        collection.update_one({"user_id": userID}, {"$set": data})
+        query = {"user_id": userID}
+        if version is not None:
+            # 舊資料可能還沒有 version 欄位，視為 0
+            query["version"] = version if version else {"$in": [0, None]}
+        result = collection.update_one(
+            query,
+            {"$set": dict(changed, last_active=_now()), "$inc": {"version": 1}},
+        )
+        if result.matched_count == 0 and version is not None:
+            cache.invalidate(userID)
+            raise ConflictError(f"user {userID} was modified concurrently")
+        new_version = (version or 0) + 1
+        if version is None:
+            # 沒有檢查 version 時不知道寫入後的版本
+            cache.invalidate(userID)
+        else:
+            cache.merge(
+                userID, dict(_session_view(changed), version=new_version), version or 0
+            )
+        return new_version
     else:
-        user_map[userID] = data
+        new_version = (version or 0) + 1
+        value = dict(data, version=new_version)
+        if version is None:
+            user_map.put(userID, value)
+        elif not user_map.compare_and_set(userID, version, value):
+            raise ConflictError(f"user {userID} was modified concurrently")
+        return new_version
 
 
 # 刪除文件
 def delete_data(userID: str):
     global collection
+    work = _current_work(userID)
+    if work is not None:
+        work["snapshot"] = None
+        work["pending"] = None
     if collection != None:
         collection.delete_one({"user_id": userID})
+        cache.invalidate(userID)
+    else:
+        user_map.invalidate(userID)
+
+
+# 記錄處理過的 webhook 事件 id，第一次記錄回傳 True，已經有了回傳 False
+def mark_event(eventID: str, window: float) -> bool:
+    global event_collection
+    if event_collection != None:
+        try:
+            event_collection.insert_one({"_id": eventID, "created": _now()})
+        except DuplicateKeyError:
+            return False
+        return True
+    return user_map.mark_event(eventID, window)
+
+
+# 依 user_id 順序逐批讀出使用者資料，after 指定從哪個 user_id 之後開始，fields 同 query_data
+# 給批次作業 (例如提醒排程) 使用，不經過快取也不更新 last_active
+def iter_users(after=None, fields=None, batch_size: int = 500):
+    global collection
+    if collection != None:
+        query = {"user_id": {"$gt": after}} if after is not None else {}
+        cursor = (
+            collection.find(query, _projection(fields))
+            .sort("user_id", 1)
+            .batch_size(batch_size)
+        )
+        yield from cursor
     else:
-        if userID in user_map:
-            del user_map[userID]
+        for key, data in user_map.scan(after, batch_size):
+            data["user_id"] = key
+            if fields is not None:
+                data = {k: data[k] for k in fields if k in data}
+            yield data
+
+
+# 快取的命中率等統計
+def cache_stats() -> dict:
+    return cache.stats()
+
+
+# 記憶體 / SQLite 模式的筆數與移除統計
+def store_stats() -> dict:
+    return user_map.stats()
+
 
 # 起始資料庫
 def init_db():
-    global collection
+    global collection, event_collection, user_map
     enable_db = os.getenv("ENABLE_DB", "false")
-    if enable_db.lower() == "true":
+    backend = os.getenv("DB_BACKEND", "").lower()
+    if (
+        backend == ""
+        and enable_db.lower() != "true"
+        and int(os.getenv("WEB_CONCURRENCY", "1")) > 1
+    ):
+        # 多個 gunicorn worker 各自的記憶體不相通，改用同一台主機共用的檔案
+        backend = "shared"
+
+    if backend == "sqlite":
+        user_map = SqliteStore(
+            os.getenv("SQLITE_PATH", "sessions.db"),
+            batch_size=int(os.getenv("SQLITE_BATCH_SIZE", "64")),
+        )
+    elif backend == "shared":
+        user_map = SqliteStore(
+            _shared_store_path(),
+            batch_size=int(os.getenv("SQLITE_BATCH_SIZE", "64")),
+        )
+    elif enable_db.lower() == "true":
         dbHost = os.getenv("DBHOST")
         if dbHost != None:
             dbClient = MongoClient(dbHost)
@@ -71,6 +644,63 @@ def init_db():
             database = dbClient[dbName]
             collectionName = os.getenv("collectionName")
             collection = database[collectionName]
+            event_collection = database[collectionName + "_events"]
+            ensure_indexes()
+
+
+def _shared_store_path() -> str:
+    path = os.getenv("SHARED_STORE_PATH")
+    if path:
+        return path
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, "linebot-sessions.db")
+
+
+# 建立並檢查索引，已經存在的索引不會重建
+def ensure_indexes():
+    global collection
+    try:
+        collection.create_index("user_id", unique=True)
+    except OperationFailure as e:
+        # 例如已經有重複的 user_id 或同名但非唯一的索引
+        print(f"Error creating user_id index: {e}")
+
+    ttl = int(os.getenv("SESSION_TTL", "0"))
+    if ttl <= 0:
+        # 之前用預設值建立過的 TTL 索引也要移除，否則會員資料仍會被刪除
+        for name, index in collection.index_information().items():
+            if index["key"] == [("last_active", 1)] and "expireAfterSeconds" in index:
+                collection.drop_index(name)
+    else:
+        try:
+            collection.create_index("last_active", expireAfterSeconds=ttl)
+        except OperationFailure:
+            # 索引已存在但時間不同，直接修改設定
+            collection.database.command(
+                "collMod",
+                collection.name,
+                index={"keyPattern": {"last_active": 1}, "expireAfterSeconds": ttl},
+            )
+
+    # 事件 id 只需要保留去重的時間窗
+    window = int(float(os.getenv("DEDUP_WINDOW", "600")))
+    try:
+        event_collection.create_index("created", expireAfterSeconds=window)
+    except OperationFailure:
+        collection.database.command(
+            "collMod",
+            event_collection.name,
+            index={"keyPattern": {"created": 1}, "expireAfterSeconds": window},
+        )
+
+    indexes = collection.index_information()
+    unique = any(
+        index["key"] == [("user_id", 1)] and index.get("unique")
+        for index in indexes.values()
+    )
+    if not unique:
+        print("Warning: user_id is not uniquely indexed")
+    return unique
 
 
 def main():
@@ -0,0 +1,108 @@
+"""
+進度條卡片 (Flex Message)
+progress_bar() 產生完整的 dict，render() 建立 FlexMessage 並依 (title, msg, current, max) 快取
+點數的組合只有幾十種，大部分集點回覆都不用再建立和驗證整棵 pydantic 物件
+
+render() 回傳的是共用的物件，不可以修改內容
+
+"""
+
+from functools import lru_cache
+
+from linebot.v3.messaging import FlexContainer, FlexMessage
+
+# 三種集點: 卡片標題和集滿的點數，集點、進度查詢和提醒都用這張表
+CARDS = {
+    "healthMeasurement": ("量血壓次數", 15),
+    "healthEducation": ("AI衛教次數", 2),
+    "exercise": ("運動次數", 6),
+}
+
+
+# 產生進度條
+def progress_bar(title: str, msg: str, current: int, max: int) -> str:
+    # 計算進度條的長度
+    progress = int(float(current) / float(max) * 100)
+    if progress > 100:
+        progress = 100
+
+    # 定義 Flex Message 的 JSON 格式
+    data = {
+        "type": "carousel",
+        "contents": [
+            {
+                "type": "bubble",
+                "size": "kilo",
+                "header": {
+                    "type": "box",
+                    "layout": "vertical",
+                    "backgroundColor": "#27ACB2",
+                    "paddingTop": "19px",
+                    "paddingAll": "12px",
+                    "paddingBottom": "16px",
+                    "contents": [
+                        {
+                            "type": "text",
+                            "text": title,
+                            "color": "#FFFFFF",
+                            "size": "md",
+                            "align": "start",
+                            "gravity": "center",
+                        },
+                        {
+                            "type": "text",
+                            "text": str(current) + "/" + str(max),
+                            "color": "#ffffff",
+                            "align": "start",
+                            "size": "xs",
+                            "gravity": "center",
+                            "margin": "lg",
+                        },
+                        {
+                            "type": "box",
+                            "layout": "vertical",
+                            "contents": [
+                                {
+                                    "type": "box",
+                                    "layout": "vertical",
+                                    "contents": [{"type": "filler"}],
+                                    "width": str(progress) + "%",
+                                    "backgroundColor": "#0D8186",
+                                    "height": "8px",
+                                }
+                            ],
+                            "backgroundColor": "#9FD8E3A0",
+                            "height": "8px",
+                            "margin": "sm",
+                        },
+                    ],
+                },
+                "body": {
+                    "type": "box",
+                    "layout": "vertical",
+                    "flex": 1,
+                    "contents": [
+                        {
+                            "type": "text",
+                            "text": msg,
+                            "color": "#8C8C8C",
+                            "size": "sm",
+                            "wrap": True,
+                        }
+                    ],
+                },
+                "styles": {"footer": {"separator": False}},
+            }
+        ],
+    }
+
+    return data
+
+
+# 產生進度條訊息，相同的參數直接回傳快取的訊息
+@lru_cache(maxsize=256)
+def render(title: str, msg: str, current: int, max: int) -> FlexMessage:
+    return FlexMessage(
+        alt_text="hello",
+        contents=FlexContainer.from_dict(progress_bar(title, msg, current, max)),
+    )
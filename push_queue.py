@@ -0,0 +1,313 @@
+"""
+主動推播 (push) 的佇列模組
+所有 push 訊息先放進佇列，由背景的送出執行緒依速率限制送給 LINE
+短時間內要送給同一個使用者的訊息會合併成一次 push (最多 5 則)，節省 API 呼叫次數
+
+同一個使用者的訊息依放入的順序送出
+收到 429 / 5xx 時依 Retry-After (沒有的話用指數退避) 暫停所有送出，之後重送同一批訊息
+重送時帶同一個 X-Line-Retry-Key，LINE 不會重複送出
+
+環境變數:
+    PUSH_RATE        每秒最多幾次 push 呼叫，預設 20
+    PUSH_BURST       短時間內最多連續送出幾次，預設 20
+    PUSH_LINGER_MS   訊息放入後等待合併的毫秒數，預設 50
+    PUSH_WORKERS     送出執行緒數量，預設 2
+    PUSH_QUEUE_SIZE  等待送出的訊息上限，預設 5000，滿了 push 會回傳 False
+    PUSH_MAX_RETRIES 429 / 5xx 最多重送幾次，預設 5
+    PUSH_BACKOFF     沒有 Retry-After 時第一次重送的等待秒數，預設 1
+    PUSH_DRAIN_TIMEOUT 結束時等待佇列送完的秒數，預設 10
+
+"""
+
+import atexit
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from collections import deque
+
+from linebot.v3.messaging import ApiException, PushMessageRequest
+
+import line_client
+
+logger = logging.getLogger(__name__)
+
+# LINE 一次 push 最多 5 則訊息
+MAX_MESSAGES = 5
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    # 取得一個 token，不夠的話等到有為止
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                else:
+                    self.tokens = min(
+                        self.burst, self.tokens + (now - self.updated) * self.rate
+                    )
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    # 被 LINE 限速時暫停一段時間，暫停結束後從空的 bucket 開始
+    def pause(self, seconds: float):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+            self.updated = self.paused_until
+
+
+class _Batch:
+    def __init__(self, messages):
+        self.messages = messages
+        self.retry_key = str(uuid.uuid4())
+        self.attempts = 0
+
+
+# 定義全域變數
+_threads = []
+_bucket = None
+_pid = None
+_lock = threading.Lock()
+_cond = threading.Condition(_lock)
+_stopping = False
+_stopped = False
+
+# user_id -> 等待送出的訊息，正在送出的使用者也會留在這裡 (可能是空的)
+_mailboxes = {}
+# user_id -> 送出失敗要重送的那一批訊息
+_retries = {}
+# (可以送出的時間, user_id)，依時間排序
+_ready = deque()
+_pending = 0
+_running = 0
+
+_stats = {
+    "queued": 0,
+    "sent": 0,
+    "push_calls": 0,
+    "coalesced": 0,
+    "rate_limited": 0,
+    "retried": 0,
+    "failed": 0,
+    "dropped": 0,
+}
+
+
+def _linger() -> float:
+    return int(os.getenv("PUSH_LINGER_MS", "50")) / 1000
+
+
+def _queue_size() -> int:
+    return max(1, int(os.getenv("PUSH_QUEUE_SIZE", "5000")))
+
+
+def _max_retries() -> int:
+    return int(os.getenv("PUSH_MAX_RETRIES", "5"))
+
+
+# 被限速或伺服器錯誤時要等待的秒數，有 Retry-After 就照它的
+def retry_after(e: ApiException, attempts: int) -> float:
+    value = (e.headers or {}).get("Retry-After")
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+    backoff = float(os.getenv("PUSH_BACKOFF", "1"))
+    return random.uniform(backoff, backoff * 2**attempts)
+
+
+# 取出下一個可以送出的使用者和一批訊息
+def _take():
+    global _pending, _running
+    with _cond:
+        while True:
+            if _ready:
+                ready_at, user_id = _ready[0]
+                delay = ready_at - time.monotonic()
+                if delay <= 0 or _stopping:
+                    _ready.popleft()
+                    break
+                _cond.wait(delay)
+            elif _stopped:
+                return None, None
+            else:
+                _cond.wait()
+        batch = _retries.pop(user_id, None)
+        if batch is None:
+            mailbox = _mailboxes[user_id]
+            n = min(MAX_MESSAGES, len(mailbox))
+            batch = _Batch([mailbox.popleft() for _ in range(n)])
+            _pending -= n
+        _running += 1
+        return user_id, batch
+
+
+def _send(user_id: str, batch: _Batch) -> bool:
+    _bucket.acquire()
+    try:
+        line_client.get_messaging_api().push_message_with_http_info(
+            PushMessageRequest(to=user_id, messages=batch.messages),
+            x_line_retry_key=batch.retry_key,
+        )
+    except ApiException as e:
+        # 409 表示同一個 retry key 已經送成功過
+        if e.status == 409:
+            return True
+        if e.status not in RETRY_STATUS or batch.attempts >= _max_retries():
+            logger.error(f"Push to {user_id} failed: {e.status} {e.reason}")
+            _count("failed", len(batch.messages))
+            return True
+        # 暫停所有送出，這一批排在最前面，暫停結束後第一個重送
+        delay = retry_after(e, batch.attempts)
+        _bucket.pause(delay)
+        if e.status == 429:
+            _count("rate_limited")
+        logger.warning(f"Push to {user_id} got {e.status}, retry in {delay:.1f}s")
+        batch.attempts += 1
+        _count("retried")
+        with _cond:
+            _retries[user_id] = batch
+            _ready.appendleft((time.monotonic(), user_id))
+        return False
+    except Exception as e:
+        logger.exception(f"Push to {user_id} failed: {e}")
+        _count("failed", len(batch.messages))
+        return True
+    _count("push_calls")
+    _count("sent", len(batch.messages))
+    return True
+
+
+# 送出執行緒的主迴圈
+def _run():
+    global _running
+    while True:
+        user_id, batch = _take()
+        if user_id is None:
+            return
+        done = True
+        try:
+            done = _send(user_id, batch)
+        finally:
+            with _cond:
+                _running -= 1
+                if done:
+                    if _mailboxes[user_id]:
+                        _ready.append((time.monotonic(), user_id))
+                    else:
+                        del _mailboxes[user_id]
+                _cond.notify_all()
+
+
+def _count(name: str, n: int = 1):
+    with _lock:
+        _stats[name] += n
+
+
+def _ensure_started():
+    global _threads, _bucket, _pid, _stopping, _stopped
+    global _mailboxes, _retries, _ready, _pending, _running
+    if _pid == os.getpid():
+        return
+    with _lock:
+        if _pid == os.getpid():
+            return
+        _bucket = TokenBucket(
+            float(os.getenv("PUSH_RATE", "20")), int(os.getenv("PUSH_BURST", "20"))
+        )
+        _mailboxes = {}
+        _retries = {}
+        _ready = deque()
+        _pending = 0
+        _running = 0
+        _threads = []
+        _stopping = False
+        _stopped = False
+        for i in range(max(1, int(os.getenv("PUSH_WORKERS", "2")))):
+            t = threading.Thread(target=_run, name=f"push-sender-{i}", daemon=True)
+            t.start()
+            _threads.append(t)
+        _pid = os.getpid()
+
+
+# 放入要推播給使用者的訊息，佇列滿了或正在關閉時回傳 False
+def push(user_id: str, *messages) -> bool:
+    global _pending
+    if not messages:
+        return True
+    _ensure_started()
+    with _cond:
+        if _stopping or _pending + len(messages) > _queue_size():
+            logger.warning(f"Push queue is full, dropping messages to {user_id}")
+            _stats["dropped"] += len(messages)
+            return False
+        mailbox = _mailboxes.get(user_id)
+        if mailbox is None:
+            mailbox = _mailboxes[user_id] = deque()
+            _ready.append((time.monotonic() + _linger(), user_id))
+        elif mailbox:
+            # 還沒送出的訊息，這次的會跟它們合併成同一次 push
+            _stats["coalesced"] += len(messages)
+        mailbox.extend(messages)
+        _pending += len(messages)
+        _stats["queued"] += len(messages)
+        _cond.notify()
+    return True
+
+
+def stats() -> dict:
+    with _lock:
+        result = dict(_stats)
+        if _pid == os.getpid():
+            result["pending"] = _pending
+            result["users"] = len(_mailboxes)
+        else:
+            result["pending"] = 0
+            result["users"] = 0
+        return result
+
+
+# 停止接收新訊息，等佇列內的訊息送完再結束送出執行緒
+def shutdown(timeout: float = None):
+    global _stopping, _stopped, _pid
+    if _pid != os.getpid():
+        return
+    if timeout is None:
+        timeout = float(os.getenv("PUSH_DRAIN_TIMEOUT", "10"))
+    deadline = time.monotonic() + timeout
+    with _cond:
+        _stopping = True
+        _cond.notify_all()
+        while _pending or _running or _retries:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning(f"Push queue not drained, {_pending} messages left")
+                break
+            _cond.wait(remaining)
+        _stopped = True
+        _cond.notify_all()
+    for t in _threads:
+        t.join(max(0, deadline - time.monotonic()))
+    _pid = None
+
+
+atexit.register(shutdown)
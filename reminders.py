@@ -0,0 +1,286 @@
+"""
+定期提醒模組
+每週固定時間找出這週還沒有集點的會員，用 multicast 一次送給最多 500 人
+提醒內含目前的集點進度卡片 (progress_card)，集點數相同的會員放在同一次 multicast
+
+會員資料用 persistence.iter_users 依 user_id 順序逐批讀取，不會一次全部載入記憶體
+每送完一批就把進度寫到 checkpoint 檔，重新啟動後從上次的位置繼續，同一週不會重送
+同一台主機上的多個 gunicorn worker 用檔案鎖選出一個負責送出
+
+環境變數:
+    ENABLE_REMINDERS     設成 true 才會啟動排程，預設 false
+    REMINDER_KIND        要提醒的集點項目，預設 healthMeasurement
+    REMINDER_WEEKDAY     每週星期幾送出 (0 是星期一)，預設 4
+    REMINDER_HOUR        幾點之後送出 (依主機時區，可以用 TZ 設定)，預設 10
+    REMINDER_CHECK_INTERVAL 多久檢查一次是否該送出 (秒)，預設 300
+    REMINDER_PAGE_SIZE   每批讀取幾位會員，送完一批寫一次 checkpoint，預設 2000
+    REMINDER_RATE        每秒最多幾次 multicast 呼叫，預設 5
+    REMINDER_MAX_RETRIES 429 / 5xx 最多重送幾次，預設 5
+    REMINDER_CHECKPOINT  checkpoint 檔案路徑，預設 reminders.checkpoint.json
+    REMINDER_LOCK        選出負責送出的 worker 用的鎖定檔，預設放在暫存目錄
+
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from linebot.v3.messaging import ApiException, MulticastRequest, TextMessage
+
+import line_client
+import persistence as db
+import progress_card
+from leader_lock import LeaderLock
+from progress_card import CARDS
+from push_queue import RETRY_STATUS, TokenBucket, retry_after
+
+logger = logging.getLogger(__name__)
+
+# LINE 一次 multicast 最多 500 位收件者
+MAX_RECIPIENTS = 500
+
+# 各集點項目的提醒文字，卡片標題和集滿的點數見 progress_card.CARDS
+TEXTS = {
+    "healthMeasurement": "這週還沒有量血壓喔！量完記得回來集點",
+    "healthEducation": "這週還沒有看 AI 衛教喔！看完記得回來集點",
+    "exercise": "這週還沒有運動喔！運動完記得回來集點",
+}
+
+# 定義全域變數
+_pid = None
+_lock = threading.Lock()
+_leader = None
+_stats = {"runs": 0, "multicasts": 0, "recipients": 0, "failed": 0}
+
+
+def _enabled() -> bool:
+    return os.getenv("ENABLE_REMINDERS", "false").lower() == "true"
+
+
+def _checkpoint_path() -> str:
+    return os.getenv("REMINDER_CHECKPOINT", "reminders.checkpoint.json")
+
+
+def _lock_path() -> str:
+    return os.getenv(
+        "REMINDER_LOCK", os.path.join(tempfile.gettempdir(), "linebot-reminders.lock")
+    )
+
+
+# 這週一 00:00 (主機時區)
+def week_start(now: datetime) -> datetime:
+    day = now - timedelta(days=now.weekday())
+    return day.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+# 這一輪的名稱，同一週同一個項目只送一次
+def run_id(kind: str, now: datetime) -> str:
+    year, week, _ = now.isocalendar()
+    return f"{kind}-{year}-W{week:02d}"
+
+
+def load_checkpoint() -> dict:
+    try:
+        with open(_checkpoint_path(), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+# 先寫到暫存檔再改名，寫到一半當掉也不會留下壞掉的檔案
+def save_checkpoint(checkpoint: dict):
+    path = _checkpoint_path()
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+# 是不是會員: 透過 bot 註冊、連結成功，或是有集點紀錄 (加上 linked 之前就連結的會員)
+# 登出時 linked 和點數會清掉
+def is_member(user: dict) -> bool:
+    if user.get("register") or user.get("linked"):
+        return True
+    return any(user.get(f"{kind}_count") is not None for kind in CARDS)
+
+
+# 這週還沒有集點的會員
+def needs_reminder(user: dict, kind: str, since: float) -> bool:
+    if not is_member(user):
+        return False
+    stamped_at = user.get(f"{kind}_at")
+    return stamped_at is None or stamped_at < since
+
+
+# 不知道點數 (count 是 None) 時只送提醒文字，不顯示猜測的進度
+def build_messages(kind: str, count: int):
+    title, max = CARDS[kind]
+    text = TEXTS[kind]
+    if count is None:
+        return [TextMessage(text=text)]
+    return [
+        progress_card.render(title, "目前集點進度", count, max),
+        TextMessage(text=text),
+    ]
+
+
+def _multicast(bucket: TokenBucket, user_ids, messages, retry_key: str) -> bool:
+    attempts = 0
+    while True:
+        bucket.acquire()
+        try:
+            line_client.get_messaging_api().multicast_with_http_info(
+                MulticastRequest(to=user_ids, messages=messages),
+                x_line_retry_key=retry_key,
+            )
+            return True
+        except ApiException as e:
+            # 409 表示同一個 retry key 已經送成功過 (例如上次送完還沒寫 checkpoint 就當掉)
+            if e.status == 409:
+                return True
+            if e.status not in RETRY_STATUS or attempts >= int(
+                os.getenv("REMINDER_MAX_RETRIES", "5")
+            ):
+                logger.error(f"Multicast failed: {e.status} {e.reason}")
+                return False
+            delay = retry_after(e, attempts)
+            logger.warning(f"Multicast got {e.status}, retry in {delay:.1f}s")
+            bucket.pause(delay)
+            attempts += 1
+
+
+# 送出一批會員的提醒，依集點數分組，每組再切成最多 500 人一次
+def _send_page(bucket, run: str, kind: str, groups: dict):
+    for count, user_ids in groups.items():
+        messages = build_messages(kind, count)
+        for i in range(0, len(user_ids), MAX_RECIPIENTS):
+            chunk = user_ids[i : i + MAX_RECIPIENTS]
+            # 同一批收件者重送時 retry key 相同，LINE 不會重複送出
+            retry_key = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{run}/{count}/{chunk[0]}"))
+            if _multicast(bucket, chunk, messages, retry_key):
+                _count("multicasts")
+                _count("recipients", len(chunk))
+            else:
+                _count("failed", len(chunk))
+
+
+# 送出這週的提醒，已經送完的話直接返回，回傳這次送出的人數
+def run_once(now: datetime = None, kind: str = None) -> int:
+    now = now or datetime.now().astimezone()
+    kind = kind or os.getenv("REMINDER_KIND", "healthMeasurement")
+    run = run_id(kind, now)
+    checkpoint = load_checkpoint()
+    if checkpoint.get("run") != run:
+        checkpoint = {"run": run, "after": None, "sent": 0, "done": False}
+    if checkpoint["done"]:
+        return 0
+    if checkpoint["after"] is not None:
+        logger.info(f"Resume reminders {run} after {checkpoint['after']}")
+
+    since = week_start(now).timestamp()
+    page_size = int(os.getenv("REMINDER_PAGE_SIZE", "2000"))
+    rate = float(os.getenv("REMINDER_RATE", "5"))
+    bucket = TokenBucket(rate, max(1, int(rate)))
+    fields = ("user_id", "register", "linked", f"{kind}_at") + tuple(
+        f"{k}_count" for k in CARDS
+    )
+    sent = 0
+
+    def flush(groups, after):
+        nonlocal sent
+        _send_page(bucket, run, kind, groups)
+        n = sum(len(user_ids) for user_ids in groups.values())
+        sent += n
+        checkpoint["after"] = after
+        checkpoint["sent"] += n
+        save_checkpoint(checkpoint)
+
+    groups = defaultdict(list)
+    scanned = 0
+    last = None
+    for user in db.iter_users(checkpoint["after"], fields, batch_size=page_size):
+        last = user["user_id"]
+        scanned += 1
+        if needs_reminder(user, kind, since):
+            groups[user.get(f"{kind}_count")].append(last)
+        if scanned % page_size == 0:
+            flush(groups, last)
+            groups = defaultdict(list)
+    if last is not None:
+        flush(groups, last)
+    checkpoint["done"] = True
+    save_checkpoint(checkpoint)
+    _count("runs")
+    logger.info(f"Reminders {run} done, {checkpoint['sent']} users")
+    return sent
+
+
+# 拿到檔案鎖的行程負責送出，鎖會一直保留到行程結束
+def _due(now: datetime) -> bool:
+    weekday = int(os.getenv("REMINDER_WEEKDAY", "4"))
+    hour = int(os.getenv("REMINDER_HOUR", "10"))
+    due = week_start(now) + timedelta(days=weekday, hours=hour)
+    return now >= due
+
+
+def _loop():
+    interval = float(os.getenv("REMINDER_CHECK_INTERVAL", "300"))
+    while True:
+        try:
+            now = datetime.now().astimezone()
+            # 其他 worker 當掉釋放鎖之後，下一次檢查時會由別的 worker 接手
+            if _due(now) and _leader.acquire():
+                run_once(now)
+        except Exception as e:
+            logger.exception(f"Error while sending reminders: {e}")
+        time.sleep(interval)
+
+
+# 啟動排程執行緒，每個行程只會啟動一次
+# gunicorn 會在 import 之後才 fork，要在子行程內 (例如第一個請求) 呼叫
+def start():
+    global _pid, _leader
+    if _pid == os.getpid() or not _enabled():
+        return
+    with _lock:
+        if _pid == os.getpid():
+            return
+        _leader = LeaderLock(_lock_path())
+        threading.Thread(target=_loop, name="reminders", daemon=True).start()
+        _pid = os.getpid()
+
+
+def _count(name: str, n: int = 1):
+    with _lock:
+        _stats[name] += n
+
+
+def stats() -> dict:
+    with _lock:
+        result = dict(_stats, leader=_leader is not None and _leader.held())
+    # checkpoint 的 after 是會員的 LINE user id，/status 沒有驗證，只回報進度
+    checkpoint = load_checkpoint()
+    result["checkpoint"] = {
+        "run": checkpoint.get("run"),
+        "sent": checkpoint.get("sent", 0),
+        "done": checkpoint.get("done", False),
+    }
+    return result
+
+
+if __name__ == "__main__":
+    # 手動送出這週的提醒: python reminders.py
+    from dotenv import load_dotenv
+    from linebot.v3.messaging import Configuration
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    line_client.init(Configuration(access_token=os.getenv("ACCESS_TOKEN")))
+    db.init_db()
+    print(f"Sent reminders to {run_once()} users")
@@ -0,0 +1,222 @@
+"""
+用 SQLite (WAL 模式) 存放使用者資料的模組
+介面跟 persistence.MemoryStore 一樣，可以直接替換
+(get / put / setdefault / compare_and_set / invalidate / scan)
+資料存在本機檔案，重新啟動後還在，同一台主機上的多個 gunicorn worker 可以共用同一個檔案
+
+讀取: 每個執行緒一條自己的連線，WAL 模式下讀取不會被寫入擋住
+寫入: 每個行程一個寫入執行緒，把同時送來的寫入合併成一個交易一起 commit
+      呼叫端會等到自己的資料 commit 完才返回，所以寫完馬上讀得到
+SQL 都是固定字串加參數，sqlite3 會快取編譯好的 statement 重複使用
+
+"""
+
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    user_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    last_active REAL NOT NULL
+)
+"""
+_SELECT = "SELECT data FROM sessions WHERE user_id = ?"
+_UPSERT = (
+    "INSERT INTO sessions (user_id, data, last_active) VALUES (?, ?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET "
+    "data = excluded.data, last_active = excluded.last_active"
+)
+_INSERT_IGNORE = (
+    "INSERT INTO sessions (user_id, data, last_active) VALUES (?, ?, ?) "
+    "ON CONFLICT(user_id) DO NOTHING"
+)
+_COMPARE_AND_SET = (
+    "UPDATE sessions SET data = ?, last_active = ? "
+    "WHERE user_id = ? AND COALESCE(json_extract(data, '$.version'), 0) = ?"
+)
+_EXISTS = "SELECT 1 FROM sessions WHERE user_id = ?"
+_DELETE = "DELETE FROM sessions WHERE user_id = ?"
+_EVENT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    event_id TEXT PRIMARY KEY,
+    created REAL NOT NULL
+)
+"""
+_EVENT_INSERT = (
+    "INSERT INTO events (event_id, created) VALUES (?, ?) ON CONFLICT DO NOTHING"
+)
+_EVENT_PURGE = "DELETE FROM events WHERE created < ?"
+_COUNT = "SELECT COUNT(*) FROM sessions"
+_SCAN = "SELECT user_id, data FROM sessions WHERE user_id > ? ORDER BY user_id LIMIT ?"
+
+
+class _Write:
+    def __init__(self, fn):
+        self.fn = fn
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SqliteStore:
+    def __init__(self, path: str, batch_size: int = 64, busy_timeout: float = 5.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.busy_timeout = busy_timeout
+        self.commits = 0
+        self.writes = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._queue = None
+        self._writer_pid = None
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(_SCHEMA)
+        conn.execute(_EVENT_SCHEMA)
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path, timeout=self.busy_timeout, isolation_level=None
+        )
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # 每個執行緒自己的讀取連線，fork 之後要重新連線
+    def _reader(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _write_loop(self, q):
+        conn = self._connect()
+        while True:
+            batch = [q.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit(conn, batch)
+
+    def _commit(self, conn, batch):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for write in batch:
+                write.result = write.fn(conn)
+            conn.execute("COMMIT")
+            self.commits += 1
+            self.writes += len(batch)
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            if len(batch) > 1:
+                # 一筆出錯不要拖累同一批的其他寫入，改成一筆一筆重做
+                for write in batch:
+                    self._commit(conn, [write])
+                return
+            batch[0].error = e
+        for write in batch:
+            write.done.set()
+
+    # 把寫入交給寫入執行緒，等 commit 完成才返回
+    def _execute_write(self, fn):
+        if self._writer_pid != os.getpid():
+            with self._lock:
+                if self._writer_pid != os.getpid():
+                    self._queue = queue.Queue()
+                    threading.Thread(
+                        target=self._write_loop,
+                        args=(self._queue,),
+                        name="sqlite-writer",
+                        daemon=True,
+                    ).start()
+                    self._writer_pid = os.getpid()
+        write = _Write(fn)
+        self._queue.put(write)
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def get(self, key):
+        row = self._reader().execute(_SELECT, (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        data = json.dumps(value, ensure_ascii=False)
+        self._execute_write(
+            lambda conn: conn.execute(_UPSERT, (key, data, time.time()))
+        )
+
+    # 不存在才寫入，回傳資料庫內的內容
+    def setdefault(self, key, value):
+        found = self.get(key)
+        if found is not None:
+            return found
+        data = json.dumps(value, ensure_ascii=False)
+
+        def insert(conn):
+            conn.execute(_INSERT_IGNORE, (key, data, time.time()))
+            return conn.execute(_SELECT, (key,)).fetchone()[0]
+
+        return json.loads(self._execute_write(insert))
+
+    # version 跟目前存的一樣才寫入，資料已經不在時直接寫入
+    def compare_and_set(self, key, version: int, value) -> bool:
+        data = json.dumps(value, ensure_ascii=False)
+
+        def update(conn):
+            now = time.time()
+            if conn.execute(_COMPARE_AND_SET, (data, now, key, version)).rowcount:
+                return True
+            if conn.execute(_EXISTS, (key,)).fetchone() is not None:
+                return False
+            conn.execute(_UPSERT, (key, data, now))
+            return True
+
+        return self._execute_write(update)
+
+    def invalidate(self, key):
+        self._execute_write(lambda conn: conn.execute(_DELETE, (key,)))
+
+    # 記錄 webhook 事件 id，第一次記錄回傳 True，順便清掉超過時間窗的舊記錄
+    def mark_event(self, event_id: str, window: float) -> bool:
+        def insert(conn):
+            now = time.time()
+            conn.execute(_EVENT_PURGE, (now - window,))
+            return conn.execute(_EVENT_INSERT, (event_id, now)).rowcount == 1
+
+        return self._execute_write(insert)
+
+    # 依 key 排序逐批取出 (key, 資料)，從 after 之後開始
+    # 每批都是一次新的查詢 (keyset 分頁)，不會長時間佔住讀取的交易
+    def scan(self, after=None, batch_size: int = 500):
+        after = after or ""
+        while True:
+            rows = self._reader().execute(_SCAN, (after, batch_size)).fetchall()
+            for key, data in rows:
+                yield key, json.loads(data)
+            if len(rows) < batch_size:
+                return
+            after = rows[-1][0]
+
+    def stats(self) -> dict:
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "size": self._reader().execute(_COUNT).fetchone()[0],
+            "commits": self.commits,
+            "writes": self.writes,
+            "writes_per_commit": self.writes / self.commits if self.commits else 0.0,
+        }
@@ -0,0 +1,180 @@
+"""
+每位使用者三種集點點數的快取，讓「集點進度」不用集點也能馬上顯示進度卡片
+集點成功時用後端回傳的點數更新 (只更新那一項，那一項視為最新)，登出或取消好友時清除
+點數只先記在離線佇列時，只清掉那一項
+超過 STAMP_COUNTER_TTL 的項目仍然先顯示 (標示為最近一次的進度)，同時在背景向後端重新查詢
+快取內沒有的項目先用使用者資料內記下的點數 (persistence 的 {kind}_count)，都沒有的項目不顯示
+
+查詢點數要用後端不會集點的查詢 API，設定 BACKEND_STAMPS_PATH 之後才提供「集點進度」
+沒有設定時快取只用來記錄集點的結果，不會向後端查詢
+
+每個 gunicorn worker 各有一份快取，跟 persistence 的查詢快取一樣
+
+環境變數:
+    STAMP_COUNTER_TTL          點數多久之後要在背景重新查詢 (秒)，預設 60
+    STAMP_COUNTER_MAX_AGE      點數最多保留多久 (秒)，預設 86400
+    STAMP_COUNTER_CACHE_SIZE   最多保留幾位使用者，預設 4096
+    STAMP_COUNTER_THREADS      背景查詢的執行緒數量，預設 2
+    BACKEND_STAMPS_PATH        後端查詢點數的路徑 (見 backend_client.get_stamps)，預設不使用
+
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import progress_card
+from persistence import TTLCache
+from progress_card import CARDS
+
+logger = logging.getLogger(__name__)
+
+# 定義全域變數
+_cache = TTLCache(
+    int(os.getenv("STAMP_COUNTER_CACHE_SIZE", "4096")),
+    float(os.getenv("STAMP_COUNTER_MAX_AGE", "86400")),
+)
+_lock = threading.Lock()
+_refreshing = set()
+_executor = None
+_pid = None
+_stats = {"fresh": 0, "stale": 0, "misses": 0, "refreshes": 0, "refresh_errors": 0}
+
+
+def enabled() -> bool:
+    return bool(os.getenv("BACKEND_STAMPS_PATH"))
+
+
+def _ttl() -> float:
+    return float(os.getenv("STAMP_COUNTER_TTL", "60"))
+
+
+def _count(name: str):
+    with _lock:
+        _stats[name] += 1
+
+
+# 快取內存的是 {項目: (點數, 取得的時間)}，更新時整個換掉，不改動已經讀出去的 dict
+def _put(line_id: str, entries: dict):
+    if entries:
+        _cache.put(line_id, entries)
+    else:
+        _cache.invalidate(line_id)
+
+
+# 集點成功後用後端回傳的點數更新這一項
+def update(line_id: str, kind: str, count: int):
+    with _lock:
+        entries = dict(_cache.get(line_id) or {})
+        entries[kind] = (count, time.monotonic())
+        _put(line_id, entries)
+
+
+# 這一項的點數已經不準 (例如只先記在離線佇列)，其他項目保留
+def forget(line_id: str, kind: str):
+    with _lock:
+        entries = _cache.get(line_id)
+        if entries is None or kind not in entries:
+            return
+        entries = dict(entries)
+        del entries[kind]
+        _put(line_id, entries)
+
+
+def invalidate(line_id: str):
+    _cache.invalidate(line_id)
+
+
+# 直接向後端查詢並更新快取，查不到時回傳 None
+def load(backend, line_id: str):
+    try:
+        response = backend.get_stamps(line_id)
+        if response.status_code != 200:
+            logger.warning(f"Query stamps of {line_id} failed: {response.status_code}")
+            _count("refresh_errors")
+            return None
+        data = response.json()
+        counts = {kind: int(data.get(kind) or 0) for kind in CARDS}
+    except Exception as e:
+        logger.warning(f"Error while querying stamps of {line_id}: {e}")
+        _count("refresh_errors")
+        return None
+    now = time.monotonic()
+    _put(line_id, {kind: (count, now) for kind, count in counts.items()})
+    _count("refreshes")
+    return counts
+
+
+def _refresh(backend, line_id: str):
+    try:
+        load(backend, line_id)
+    finally:
+        with _lock:
+            _refreshing.discard(line_id)
+
+
+# 同一位使用者同時只會有一個背景查詢
+def _schedule_refresh(backend, line_id: str):
+    global _executor, _pid
+    with _lock:
+        if _pid != os.getpid():
+            # fork 之後父行程的執行緒不存在，要重新建立
+            _executor = ThreadPoolExecutor(
+                max_workers=int(os.getenv("STAMP_COUNTER_THREADS", "2")),
+                thread_name_prefix="stamp-counters",
+            )
+            _refreshing.clear()
+            _pid = os.getpid()
+        if line_id in _refreshing:
+            return
+        _refreshing.add(line_id)
+    _executor.submit(_refresh, backend, line_id)
+
+
+# 不等後端，回傳 (知道的各項點數, 過期的項目)，不知道的項目不會出現在點數內
+# 有過期或不知道的項目、且有設定查詢 API 時，會在背景重新查詢
+def lookup(backend, line_id: str, user_info: dict = None):
+    entries = _cache.get(line_id) or {}
+    now = time.monotonic()
+    counts = {}
+    stale = set()
+    for kind in CARDS:
+        if kind in entries:
+            counts[kind], fetched = entries[kind]
+            if now - fetched > _ttl():
+                stale.add(kind)
+        elif user_info is not None and user_info.get(f"{kind}_count") is not None:
+            counts[kind] = user_info[f"{kind}_count"]
+            stale.add(kind)
+    if len(counts) < len(CARDS):
+        _count("misses")
+    elif stale:
+        _count("stale")
+    else:
+        _count("fresh")
+    if enabled() and (stale or len(counts) < len(CARDS)):
+        _schedule_refresh(backend, line_id)
+    return counts, stale
+
+
+# 知道的項目各一張進度卡片，過期的點數標示為最近一次的進度
+def cards(counts: dict, stale=()) -> list:
+    return [
+        progress_card.render(
+            title,
+            "最近一次的集點進度" if kind in stale else "目前集點進度",
+            counts[kind],
+            max,
+        )
+        for kind, (title, max) in CARDS.items()
+        if kind in counts
+    ]
+
+
+def stats() -> dict:
+    with _lock:
+        result = dict(_stats, refreshing=len(_refreshing))
+    result["cache"] = _cache.stats()
+    return result
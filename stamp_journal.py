@@ -0,0 +1,213 @@
+"""
+集點的離線佇列模組
+集點的請求確定沒送到後端 (斷路器打開、連不上) 時，先寫進本機的 SQLite 日誌，不會因為後端暫時無法服務就遺失
+背景的補送執行緒等後端恢復後依序補送，每筆都帶固定的 Idempotency-Key
+讀取逾時、429、5xx 時後端可能已經集點，後端支援 Idempotency-Key (BACKEND_IDEMPOTENCY_KEYS=true) 才會記下或重新補送，
+否則補送時遇到這些情況就放棄這筆 (統計在 uncertain)，不會重複集點
+
+補送的速度有上限，失敗時以指數退避延後下一次補送，斷路器打開時整批暫停，不會把剛恢復的後端打掛
+同一台主機上的多個 gunicorn worker 共用同一個日誌檔，用檔案鎖選出一個負責補送
+
+環境變數:
+    ENABLE_STAMP_JOURNAL     設成 false 時不使用離線佇列 (後端失敗就回覆集點失敗)，預設 true
+    STAMP_JOURNAL_PATH       日誌檔案路徑，預設 stamp_journal.db
+    STAMP_REPLAY_INTERVAL    沒有要補送的資料時多久檢查一次 (秒)，預設 5
+    STAMP_REPLAY_RATE        每秒最多補送幾筆，預設 2
+    STAMP_REPLAY_BATCH       一次取出幾筆補送，預設 50
+    STAMP_REPLAY_BACKOFF     補送失敗後第一次延後的秒數，之後每次加倍，預設 10
+    STAMP_REPLAY_BACKOFF_MAX 補送失敗延後的秒數上限，預設 600
+
+"""
+
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+import requests
+
+from backend_client import CircuitOpenError, idempotency_supported, not_sent
+from leader_lock import LeaderLock
+from push_queue import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stamps (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    line_id TEXT NOT NULL,
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    last_error TEXT
+)
+"""
+_INSERT = (
+    "INSERT INTO stamps (id, kind, line_id, created, next_attempt) "
+    "VALUES (?, ?, ?, ?, ?) ON CONFLICT(id) DO NOTHING"
+)
+_DUE = (
+    "SELECT id, kind, line_id, attempts FROM stamps "
+    "WHERE next_attempt <= ? ORDER BY created LIMIT ?"
+)
+_DELETE = "DELETE FROM stamps WHERE id = ?"
+_RETRY_LATER = (
+    "UPDATE stamps SET attempts = attempts + 1, next_attempt = ?, last_error = ? "
+    "WHERE id = ?"
+)
+_PENDING = "SELECT COUNT(*), MIN(created) FROM stamps"
+
+# 定義全域變數
+_local = threading.local()
+_lock = threading.Lock()
+_pid = None
+_backend = None
+_leader = None
+_stats = {
+    "recorded": 0,
+    "replayed": 0,
+    "rejected": 0,
+    "uncertain": 0,
+    "retried": 0,
+}
+
+
+def enabled() -> bool:
+    return os.getenv("ENABLE_STAMP_JOURNAL", "true").lower() == "true"
+
+
+def _path() -> str:
+    return os.getenv("STAMP_JOURNAL_PATH", "stamp_journal.db")
+
+
+# 每個執行緒一條自己的連線，fork 之後要重新連線
+def _conn():
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.pid != os.getpid():
+        conn = sqlite3.connect(_path(), timeout=5.0, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # 集點不能遺失，每次 commit 都確實寫到磁碟
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.execute(_SCHEMA)
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+
+def _count(name: str, n: int = 1):
+    with _lock:
+        _stats[name] += n
+
+
+# 同一個事件的同一種集點，重新處理 (資料衝突) 或 LINE 重送時會得到同一個 key
+def idempotency_key(event_id: str, kind: str) -> str:
+    if not event_id:
+        return str(uuid.uuid4())
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"stamp/{event_id}/{kind}"))
+
+
+# 記下一筆還沒送到後端的集點，同一個 key 只會記一次
+def record(kind: str, line_id: str, key: str):
+    now = time.time()
+    _conn().execute(_INSERT, (key, kind, line_id, now, now))
+    _count("recorded")
+
+
+def _retry_later(conn, key: str, attempts: int, error: str):
+    base = float(os.getenv("STAMP_REPLAY_BACKOFF", "10"))
+    delay = min(float(os.getenv("STAMP_REPLAY_BACKOFF_MAX", "600")), base * 2**attempts)
+    # 加上隨機抖動，避免後端恢復時所有資料同時補送
+    next_attempt = time.time() + random.uniform(delay / 2, delay)
+    conn.execute(_RETRY_LATER, (next_attempt, error, key))
+    _count("retried")
+
+
+# 後端可能已經集點，又不能用 Idempotency-Key 去除重複，再送一次可能重複集點
+def _give_up(conn, key: str, kind: str, line_id: str, error: str):
+    logger.error(f"Give up stamp {kind} of {line_id}, it may have been applied: {error}")
+    conn.execute(_DELETE, (key,))
+    _count("uncertain")
+
+
+# 補送到期的資料，回傳成功送出的筆數
+def replay_once(backend, bucket: TokenBucket = None) -> int:
+    conn = _conn()
+    batch = int(os.getenv("STAMP_REPLAY_BATCH", "50"))
+    rows = conn.execute(_DUE, (time.time(), batch)).fetchall()
+    delivered = 0
+    for key, kind, line_id, attempts in rows:
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            response = backend.add_stamp(kind, line_id, idempotency_key=key)
+        except CircuitOpenError:
+            # 後端還沒恢復，剩下的等下一輪再送
+            break
+        except requests.RequestException as e:
+            if not_sent(e) or idempotency_supported():
+                _retry_later(conn, key, attempts, str(e))
+            else:
+                _give_up(conn, key, kind, line_id, str(e))
+            continue
+        status = response.status_code
+        if status == 200 or status == 409:
+            # 409 表示後端已經處理過這個 key
+            conn.execute(_DELETE, (key,))
+            _count("replayed")
+            delivered += 1
+        elif status == 429 or status >= 500:
+            if idempotency_supported():
+                _retry_later(conn, key, attempts, f"HTTP {status}")
+            else:
+                _give_up(conn, key, kind, line_id, f"HTTP {status}")
+        else:
+            # 後端明確拒絕 (例如不是會員)，補送也不會成功
+            logger.error(f"Drop stamp {kind} of {line_id}: HTTP {status}")
+            conn.execute(_DELETE, (key,))
+            _count("rejected")
+    return delivered
+
+
+# 拿到檔案鎖的行程負責補送，鎖會一直保留到行程結束
+def _replay_loop():
+    interval = float(os.getenv("STAMP_REPLAY_INTERVAL", "5"))
+    rate = float(os.getenv("STAMP_REPLAY_RATE", "2"))
+    bucket = TokenBucket(rate, 1)
+    while True:
+        delivered = 0
+        try:
+            if _leader.acquire():
+                delivered = replay_once(_backend, bucket)
+        except Exception as e:
+            logger.exception(f"Error while replaying stamps: {e}")
+        if delivered == 0:
+            time.sleep(interval)
+
+
+# 啟動補送執行緒，每個行程只會啟動一次
+# gunicorn 會在 import 之後才 fork，要在子行程內 (例如第一個請求) 呼叫
+def start(backend):
+    global _pid, _backend, _leader
+    if _pid == os.getpid() or not enabled():
+        return
+    with _lock:
+        if _pid == os.getpid():
+            return
+        _backend = backend
+        _leader = LeaderLock(f"{_path()}.lock")
+        threading.Thread(target=_replay_loop, name="stamp-replayer", daemon=True).start()
+        _pid = os.getpid()
+
+
+def stats() -> dict:
+    with _lock:
+        result = dict(_stats, leader=_leader is not None and _leader.held())
+    if enabled():
+        pending, oldest = _conn().execute(_PENDING).fetchone()
+        result["pending"] = pending
+        result["oldest_age"] = time.time() - oldest if oldest else 0.0
+    return result
@@ -0,0 +1,110 @@
+"""
+固定選單訊息的樣板
+選單的內容都不會變，第一次使用 (或啟動時 warm_up) 建立一次之後就一直重複使用
+不用每次回覆都重新建立並驗證 ButtonsTemplate / TemplateMessage
+
+取得的訊息是共用的物件，不可以修改內容
+
+"""
+
+import threading
+
+from linebot.v3.messaging import (
+    ButtonsTemplate,
+    MessageAction,
+    PostbackAction,
+    TemplateMessage,
+)
+
+# 定義全域變數
+_builders = {}
+_messages = {}
+_lock = threading.Lock()
+
+
+# 註冊建立樣板的函式
+def register(name: str):
+    def decorator(func):
+        _builders[name] = func
+        return func
+
+    return decorator
+
+
+# 取得樣板訊息，還沒建立過就先建立
+def get(name: str):
+    message = _messages.get(name)
+    if message is None:
+        with _lock:
+            message = _messages.get(name)
+            if message is None:
+                message = _messages[name] = _builders[name]()
+    return message
+
+
+# 啟動時先把所有樣板建立好
+def warm_up():
+    for name in _builders:
+        get(name)
+
+
+# 請問你要進行什麼操作
+@register("operation_options")
+def _operation_options():
+    buttons_template = ButtonsTemplate(
+        title="請問你要進行什麼操作？",
+        text="請點擊以下選項",
+        actions=[
+            PostbackAction(label="開始集點", data="start"),
+            PostbackAction(label="不需要操作", data="logout"),
+        ],
+    )
+    return TemplateMessage(alt_text="請問你要進行什麼操作？", template=buttons_template)
+
+
+# 集點項目選單 (start postback)
+@register("start_menu")
+def _start_menu():
+    buttons_template = ButtonsTemplate(
+        title="請問你要處理哪個項目？",
+        text="請點擊以下選項",
+        actions=[
+            PostbackAction(label="生理監測", data="monitor"),
+            PostbackAction(label="AI衛教", data="educate"),
+            PostbackAction(label="運動", data="exercise"),
+            PostbackAction(label="登出", data="logout"),
+        ],
+    )
+    return TemplateMessage(alt_text="請問你要進行什麼集點？", template=buttons_template)
+
+
+# 集點完成後的其他項目選單
+@register("other_operation_options")
+def _other_operation_options():
+    buttons_template = ButtonsTemplate(
+        title="請問你還需要處理其他項目嗎？",
+        text="請點擊以下選項",
+        actions=[
+            PostbackAction(label="生理監測", data="monitor"),
+            PostbackAction(label="AI衛教", data="educate"),
+            PostbackAction(label="運動", data="exercise"),
+            PostbackAction(label="登出", data="logout"),
+        ],
+    )
+    return TemplateMessage(
+        alt_text="請問你還需要處理其他項目嗎？", template=buttons_template
+    )
+
+
+# 加入好友時的服務選單
+@register("service_menu")
+def _service_menu():
+    buttons_template = ButtonsTemplate(
+        title="服務選單",
+        text="請點擊以下選項",
+        actions=[
+            MessageAction(label="新會員", text="新會員"),
+            PostbackAction(label="其他", data="idontknow"),
+        ],
+    )
+    return TemplateMessage(alt_text="歡迎新朋友～", template=buttons_template)